@@ -1,32 +1,491 @@
 # using pyais 1.5.0
-from pyais import decode_raw
+from pyais import NMEAMessage
+from pyais.decode import decode as decode_nmea
 
+from ais_segment import encode_segment
+
+import collections
+import functools
 import glob
 import json
+import math
+import operator
 import os
+import queue
 import serial
 import socket
+import threading
 import time
 
 
+def payload_type(payload):
+    # the message type is the first six bits, which is the first armored character
+    value = payload[0] - 48
+    if value > 40:
+        value -= 8
+    return value
+
+
+def nmea_checksum(body):
+    return functools.reduce(operator.xor, body, 0)
+
+
+class FragmentAssembler:
+
+    def __init__(self, max_groups=64, max_age=5):
+        # (channel, sequential message id, fragment count) -> (first seen, fragments so far)
+        self.groups = collections.OrderedDict()
+        self.max_groups = max_groups
+        self.max_age = max_age
+        self.stats = self.init_stats()
+
+    @staticmethod
+    def init_stats():
+        return {'completed': 0, 'expired': 0, 'corrupt': 0}
+
+    def evict(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        # groups are kept in arrival order, so only the oldest ones need checking
+        while self.groups:
+            key, (first_seen, _) = next(iter(self.groups.items()))
+            if now - first_seen < self.max_age:
+                break
+            del self.groups[key]
+            self.stats['expired'] += 1
+
+    def add(self, nmea, now=None):
+        if nmea.is_single:
+            return nmea
+        if now is None:
+            now = time.monotonic()
+        self.evict(now)
+        key = (nmea.channel, nmea.seq_id, nmea.count)
+        group = self.groups.get(key)
+        if nmea.index == 1:
+            if group is not None:
+                # the id was reused before the previous group finished
+                del self.groups[key]
+                self.stats['corrupt'] += 1
+            if len(self.groups) >= self.max_groups:
+                self.groups.popitem(last=False)
+                self.stats['expired'] += 1
+            self.groups[key] = (now, [nmea])
+            return None
+        if group is None or nmea.index != len(group[1]) + 1:
+            # orphan or out of order fragment, the group can't be completed
+            if group is not None:
+                del self.groups[key]
+            self.stats['corrupt'] += 1
+            return None
+        fragments = group[1]
+        fragments.append(nmea)
+        if len(fragments) < nmea.count:
+            return None
+        del self.groups[key]
+        self.stats['completed'] += 1
+        return NMEAMessage.assemble_from_iterable(fragments)
+
+
+class StateCache:
+
+    # message types that report a position, everything else is always written
+    POSITION_TYPES = frozenset([1, 2, 3, 4, 9, 18, 19, 21, 27])
+
+    def __init__(self, max_vessels=1024, position_m=25, speed=0.5, course=5, heading=5, keyframe_seconds=300):
+        # mmsi -> (timestamp last written, last written record), least recently seen first
+        self.vessels = collections.OrderedDict()
+        self.max_vessels = max_vessels
+        self.position_m = position_m
+        self.speed = speed
+        self.course = course
+        self.heading = heading
+        self.keyframe_seconds = keyframe_seconds
+
+    @staticmethod
+    def distance_m(lat1, lon1, lat2, lon2):
+        # equirectangular approximation, plenty for thresholds of tens of meters
+        x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+        y = math.radians(lat2 - lat1)
+        return math.hypot(x, y) * 6371000
+
+    @staticmethod
+    def angle_diff(a, b):
+        diff = abs(a - b) % 360
+        return min(diff, 360 - diff)
+
+    def changed(self, last, msg):
+        if 'lat' in msg and 'lon' in msg:
+            if self.distance_m(last['lat'], last['lon'], msg['lat'], msg['lon']) >= self.position_m:
+                return True
+        if 'speed' in msg and abs(msg['speed'] - last['speed']) >= self.speed:
+            return True
+        if 'course' in msg and self.angle_diff(msg['course'], last['course']) >= self.course:
+            return True
+        if 'heading' in msg:
+            # 511 means heading not available
+            if (msg['heading'] == 511) != (last['heading'] == 511):
+                return True
+            if msg['heading'] != 511 and self.angle_diff(msg['heading'], last['heading']) >= self.heading:
+                return True
+        return msg.get('status') != last.get('status')
+
+    def should_write(self, msg):
+        if msg.get('type') not in self.POSITION_TYPES:
+            return True
+        key = (msg['mmsi'], msg['type'])
+        state = self.vessels.get(key)
+        if state is not None:
+            self.vessels.move_to_end(key)
+            last_written, last = state
+            if msg['timestamp'] - last_written < self.keyframe_seconds and not self.changed(last, msg):
+                return False
+        elif len(self.vessels) >= self.max_vessels:
+            self.vessels.popitem(last=False)
+        self.vessels[key] = (msg['timestamp'], msg)
+        return True
+
+
+def parse_thresholds(config):
+    # "position_m=50,speed=1,keyframe_seconds=600", anything not given keeps the StateCache default
+    thresholds = {}
+    for item in config.split(','):
+        if item.strip():
+            name, value = item.split('=', 1)
+            name = name.strip()
+            if name not in ('position_m', 'speed', 'course', 'heading', 'keyframe_seconds'):
+                raise ValueError(f'unknown AIS dedupe threshold: {name}')
+            thresholds[name] = float(value)
+    return thresholds
+
+
+def last_gps_fix(gps_dir):
+    # the modem service writes qmicli position reports, newest file name sorts last
+    try:
+        files = sorted([f for f in os.listdir(gps_dir) if not f.startswith('.') and os.path.isfile(os.path.join(gps_dir, f))])
+    except FileNotFoundError:
+        return None
+    if not files:
+        return None
+    lat = lon = None
+    with open(os.path.join(gps_dir, files[-1])) as f:
+        for line in f:
+            try:
+                if 'latitude:' in line:
+                    lat = float(line.split('latitude:')[-1].split('degrees')[0].strip())
+                elif 'longitude:' in line:
+                    lon = float(line.split('longitude:')[-1].split('degrees')[0].strip())
+            except ValueError:
+                pass
+    if lat is None or lon is None:
+        return None
+    return lat, lon
+
+
+class TrafficSummary:
+
+    def __init__(self, grid_deg=0.01, max_cells=10):
+        self.grid_deg = grid_deg
+        self.max_cells = max_cells
+        self.reset()
+
+    def reset(self):
+        self.mmsis = set()
+        self.types = collections.Counter()
+        # mmsi -> last valid position seen this window
+        self.positions = {}
+        self.grid = collections.Counter()
+
+    def add(self, msg):
+        mmsi = msg.get('mmsi')
+        self.mmsis.add(mmsi)
+        self.types[msg.get('type')] += 1
+        lat = msg.get('lat')
+        lon = msg.get('lon')
+        # 91/181 mean position not available
+        if lat is None or lon is None or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            return
+        self.positions[mmsi] = (lat, lon)
+        self.grid[(round(lat / self.grid_deg), round(lon / self.grid_deg))] += 1
+
+    def summary(self, buoy=None):
+        closest_m = None
+        closest_mmsi = None
+        if buoy is not None:
+            for mmsi, (lat, lon) in self.positions.items():
+                distance = StateCache.distance_m(buoy[0], buoy[1], lat, lon)
+                if closest_m is None or distance < closest_m:
+                    closest_m = distance
+                    closest_mmsi = mmsi
+        return {
+            'unique_mmsi': len(self.mmsis),
+            'messages': sum(self.types.values()),
+            'types': {str(t): n for t, n in sorted(self.types.items())},
+            'buoy': list(buoy) if buoy is not None else None,
+            'closest_m': round(closest_m) if closest_m is not None else None,
+            'closest_mmsi': closest_mmsi,
+            # busiest cells as [lat, lon, position reports]
+            'grid_deg': self.grid_deg,
+            'grid': [[round(cell[0] * self.grid_deg, 6), round(cell[1] * self.grid_deg, 6), n]
+                     for cell, n in self.grid.most_common(self.max_cells)],
+        }
+
+
+class Publisher:
+
+    def __init__(self, path, max_pending=65536):
+        self.path = path
+        self.max_pending = max_pending
+        self.server = None
+        # socket -> pending bytes and counters for that subscriber
+        self.subscribers = {}
+        self.next_id = 1
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+        self.server.setblocking(False)
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            conn.setblocking(False)
+            self.subscribers[conn] = {'id': self.next_id, 'pending': bytearray(), 'sent': 0, 'dropped': 0}
+            self.next_id += 1
+
+    def send(self, conn, subscriber):
+        try:
+            sent = conn.send(subscriber['pending'])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # subscriber went away
+            del self.subscribers[conn]
+            conn.close()
+            return
+        del subscriber['pending'][:sent]
+
+    def publish(self, msg):
+        if not self.subscribers:
+            return
+        line = f'{json.dumps(msg)}\n'.encode('utf-8')
+        for conn, subscriber in list(self.subscribers.items()):
+            # never wait on a slow subscriber, drop its messages instead
+            if len(subscriber['pending']) + len(line) > self.max_pending:
+                subscriber['dropped'] += 1
+                continue
+            subscriber['pending'].extend(line)
+            subscriber['sent'] += 1
+            self.send(conn, subscriber)
+
+    def tick(self):
+        self.accept()
+        for conn, subscriber in list(self.subscribers.items()):
+            if subscriber['pending']:
+                self.send(conn, subscriber)
+
+    def stats(self):
+        stats = []
+        for subscriber in self.subscribers.values():
+            stats.append({'id': subscriber['id'], 'sent': subscriber['sent'], 'dropped': subscriber['dropped'], 'pending_bytes': len(subscriber['pending'])})
+            subscriber['sent'] = 0
+            subscriber['dropped'] = 0
+        return stats
+
+    def close(self):
+        for conn in self.subscribers:
+            conn.close()
+        self.subscribers = {}
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            os.remove(self.path)
+
+
+def subscribe(path):
+    # yields decoded AIS messages published by a running daisy service
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        with conn.makefile('r') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+class RecordWriter:
+
+    def __init__(self, data_dir, hostname, output_format='json', flush_seconds=5, fsync=True):
+        self.data_dir = data_dir
+        self.hostname = hostname
+        self.output_format = output_format
+        self.suffix = 'ais.seg' if output_format == 'segment' else 'ais.json'
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.filename = None
+        self.handle = None
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        # receive times of records written but not flushed yet, and read to disk latencies once they are
+        self.unflushed_rx_ms = []
+        self.latencies_ms = []
+
+    def open(self, start_time):
+        self.filename = f'{self.hostname}-{start_time}-{self.suffix}'
+        self.handle = open(os.path.join(self.data_dir, f'.{self.filename}'), 'ab')
+        self.last_flush = time.monotonic()
+
+    @staticmethod
+    def encode_jsonl(records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(f'{json.dumps(record)}\n')
+            except Exception:
+                lines.append('{"error":"'+str(record)+'"}\n')
+        return ''.join(lines).encode('utf-8')
+
+    def write(self, records):
+        if self.output_format == 'segment':
+            self.handle.write(encode_segment(records))
+        else:
+            self.handle.write(self.encode_jsonl(records))
+        self.unflushed_rx_ms.extend(record['rx_ms'] for record in records if 'rx_ms' in record)
+        self.dirty = True
+        self.tick()
+
+    def flush(self):
+        if self.dirty:
+            self.handle.flush()
+            if self.fsync:
+                os.fsync(self.handle.fileno())
+            self.dirty = False
+            now_ms = int(time.time() * 1000)
+            self.latencies_ms.extend(now_ms - rx_ms for rx_ms in self.unflushed_rx_ms)
+            self.unflushed_rx_ms = []
+        self.last_flush = time.monotonic()
+
+    def latency_stats(self):
+        latencies = sorted(self.latencies_ms)
+        self.latencies_ms = []
+        if not latencies:
+            return None
+        return {'p50': latencies[len(latencies) // 2],
+                'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+                'max': latencies[-1]}
+
+    def tick(self):
+        # bounds what a crash can lose to one flush interval, counted from when the oldest record was read
+        if not self.dirty:
+            return
+        if time.monotonic() - self.last_flush >= self.flush_seconds or (
+                self.unflushed_rx_ms and time.time() * 1000 - self.unflushed_rx_ms[0] >= self.flush_seconds * 1000):
+            self.flush()
+
+    def close(self):
+        # seal the file this writer owns, no directory scan needed
+        self.flush()
+        self.handle.close()
+        self.handle = None
+        dotfile = os.path.join(self.data_dir, f'.{self.filename}')
+        if os.path.getsize(dotfile):
+            os.rename(dotfile, os.path.join(self.data_dir, self.filename))
+        else:
+            os.remove(dotfile)
+
+    def rotate(self, start_time):
+        self.close()
+        self.open(start_time)
+
+
 class AIS:
 
-    def __init__(self, data_dir='/flash/telemetry/ais', serial_impl=serial.Serial):
+    def __init__(self, data_dir='/flash/telemetry/ais', serial_impl=serial.Serial, queue_size=4096, batch_size=None, rotate_seconds=900, skip_types=None, dedupe=True, output_format=None, flush_seconds=5, fsync=True, gps_dir='/flash/telemetry/gps', socket_path=None, max_write_errors=10, dedupe_max_vessels=None, dedupe_thresholds=None):
+        if skip_types is None:
+            skip_types = [int(t) for t in os.getenv("AIS_SKIP_TYPES", "").split(',') if t.strip()]
+        if output_format is None:
+            output_format = os.getenv("AIS_OUTPUT_FORMAT", "json")
+        if dedupe_max_vessels is None:
+            dedupe_max_vessels = int(os.getenv("AIS_DEDUPE_MAX_VESSELS", "1024"))
+        if dedupe_thresholds is None:
+            dedupe_thresholds = parse_thresholds(os.getenv("AIS_DEDUPE_THRESHOLDS", ""))
+        if output_format not in ('json', 'segment'):
+            raise ValueError(f'unknown AIS output format: {output_format}')
+        self.output_format = output_format
+        # segments carry their own dictionaries, so they pay off with bigger batches that are held longer,
+        # but never past a flush interval so a crash still loses at most one
+        if batch_size is None:
+            batch_size = 256 if output_format == 'segment' else 64
+        self.batch_seconds = flush_seconds if output_format == 'segment' else 0
         self.hostname = os.getenv("HOSTNAME", socket.gethostname())
         self.data_dir = data_dir
+        self.gps_dir = gps_dir
+        self.traffic = TrafficSummary()
+        if socket_path is None:
+            socket_path = os.getenv("AIS_SOCKET", "")
+        self.publisher = Publisher(socket_path) if socket_path else None
         self.serial_impl = serial_impl
+        # lines read off the serial port wait here until the writer thread decodes them
+        self.lines = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.rotate_seconds = rotate_seconds
+        self.running = False
+        # what stopped the writer thread, raised again from main so the container restarts
+        self.error = None
+        # failures in a row of each kind of write
+        self.write_errors = collections.Counter()
+        self.max_write_errors = max_write_errors
+        self.stats_lock = threading.Lock()
+        self.stats = self.init_stats()
+        self.last_rx_ms = 0
+        self.channels = collections.Counter()
+        self.fragments = FragmentAssembler()
+        self.state_cache = StateCache(max_vessels=dedupe_max_vessels, **dedupe_thresholds) if dedupe else None
+        self.skip_types = frozenset(skip_types)
+        # continuation fragments of skipped multi-part messages
+        self.skipped_groups = set()
+        self.writer = RecordWriter(self.data_dir, self.hostname, output_format=output_format, flush_seconds=flush_seconds, fsync=fsync)
+
+    @staticmethod
+    def init_stats():
+        return {'read': 0, 'dropped': 0, 'decoded': 0, 'bad': 0, 'backlog_max': 0,
+                'rejected_framing': 0, 'rejected_checksum': 0, 'skipped_type': 0, 'suppressed': 0,
+                'last_rx_ms': 0, 'max_gap_ms': 0, 'write_errors': 0}
+
+    @staticmethod
+    def parse(data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return NMEAMessage(data.strip())
+
+    @staticmethod
+    def decode(data):
+        return AIS.decode_message(AIS.parse(data))
+
+    @staticmethod
+    def decode_message(nmea, rx_ms=None):
+        msg = decode_nmea(nmea)
+        timestamp = int(time.time()) if rx_ms is None else rx_ms // 1000
+        for key in msg.keys():
+            if key in ['status', 'maneuver', 'epfd', 'shiptype', 'aid_type', 'station_type', 'ship_type', 'txrx', 'interval']:
+                msg[key] = msg[key].name
+        msg['timestamp'] = timestamp
+        if rx_ms is not None:
+            # when the last sentence of the message came off the serial port
+            msg['rx_ms'] = rx_ms
+        return msg
 
     @staticmethod
     def getAIS(aisc, results):
         data = aisc.readline()
         if data:
             try:
-                msg = decode_raw(data)
-                timestamp = int(time.time())
-                for key in msg.keys():
-                    if key in ['status', 'maneuver', 'epfd', 'shiptype', 'aid_type', 'station_type', 'ship_type', 'txrx', 'interval']:
-                        msg[key] = msg[key].name
-                msg['timestamp'] = timestamp
+                msg = AIS.decode(data)
                 print(f'{msg}')
                 results.append(msg)
             except Exception as e:
@@ -39,38 +498,205 @@ class AIS:
             non_dotfile = os.path.join(self.data_dir, basename[1:])
             os.rename(dotfile, non_dotfile)
 
+    def count(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] += value
+
+    def read_serial(self, aisc):
+        # never block on the queue, a stalled reader is what overflows the UART buffer
+        data = aisc.readline()
+        if data:
+            rx_ms = int(time.time() * 1000)
+            with self.stats_lock:
+                self.stats['read'] += 1
+                # long gaps between lines tell a quiet channel from a stalled UART
+                if self.last_rx_ms and rx_ms - self.last_rx_ms > self.stats['max_gap_ms']:
+                    self.stats['max_gap_ms'] = rx_ms - self.last_rx_ms
+                self.stats['last_rx_ms'] = self.last_rx_ms = rx_ms
+            try:
+                self.lines.put_nowait((rx_ms, data))
+            except queue.Full:
+                self.count('dropped')
+
+    def prefilter(self, data):
+        # cheap checks on the raw line so noise never reaches the bit level decode
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data = data.strip()
+        star = data.rfind(b'*')
+        fields = data.split(b',')
+        if len(data) < 15 or data[0] != 0x21 or star == -1 or len(fields) != 7 or not fields[5] or len(data) - star != 3:
+            self.count('rejected_framing')
+            return None
+        try:
+            checksum = int(data[star+1:], 16)
+        except ValueError:
+            self.count('rejected_framing')
+            return None
+        if checksum != nmea_checksum(data[1:star]):
+            self.count('rejected_checksum')
+            return None
+        if self.skip_types:
+            count, index, seq_id, channel, payload = fields[1:6]
+            group = (channel, seq_id, count)
+            if index == b'1':
+                if payload_type(payload) in self.skip_types:
+                    if count != b'1':
+                        if len(self.skipped_groups) > 64:
+                            self.skipped_groups.clear()
+                        self.skipped_groups.add(group)
+                    self.count('skipped_type')
+                    return None
+            elif group in self.skipped_groups:
+                if index == count:
+                    self.skipped_groups.discard(group)
+                self.count('skipped_type')
+                return None
+        return data
+
+    def handle_line(self, data, rx_ms=None):
+        data = self.prefilter(data)
+        if data is None:
+            return None
+        try:
+            # only complete fragment groups reach the decoder
+            nmea = self.fragments.add(self.parse(data))
+            if nmea is None:
+                return None
+            msg = self.decode_message(nmea, rx_ms=rx_ms)
+            self.count('decoded')
+            self.channels[nmea.channel.decode('ascii', 'replace') or '?'] += 1
+        except Exception as e:
+            self.count('bad')
+            print(f'Bad formatted data: {data}: {e}')
+            return None
+        self.traffic.add(msg)
+        if self.publisher is not None:
+            self.publisher.publish(msg)
+        if self.state_cache is not None and not self.state_cache.should_write(msg):
+            self.count('suppressed')
+            return None
+        return msg
+
+    def write_stats(self, start_time):
+        with self.stats_lock:
+            stats = self.stats
+            self.stats = self.init_stats()
+        stats.update(self.fragments.stats)
+        self.fragments.stats = self.fragments.init_stats()
+        stats['backlog'] = self.lines.qsize()
+        stats['start_time'] = start_time
+        stats['end_time'] = int(time.time())
+        seconds = max(stats['end_time'] - start_time, 1)
+        stats['channels'] = {channel: {'messages': n, 'per_minute': round(n * 60 / seconds, 1)}
+                             for channel, n in sorted(self.channels.items())}
+        self.channels = collections.Counter()
+        stats['latency_ms'] = self.writer.latency_stats()
+        stats['traffic'] = self.traffic.summary(last_gps_fix(self.gps_dir))
+        self.traffic.reset()
+        if self.publisher is not None:
+            stats['subscribers'] = self.publisher.stats()
+        print(f'AIS stats: {stats}')
+        filename = f'{self.hostname}-{start_time}-ais-stats.json'
+        tmp_filename = os.path.join(self.data_dir, f'.{filename}')
+        with open(tmp_filename, 'w') as f:
+            f.write(f'{json.dumps(stats)}\n')
+        os.rename(tmp_filename, os.path.join(self.data_dir, filename))
+        return stats
+
+    def guard_io(self, what, func, *args):
+        # a failed batch (like ENOSPC) is logged and dropped, only failing every time is fatal
+        try:
+            func(*args)
+        except OSError as err:
+            self.write_errors[what] += 1
+            self.count('write_errors')
+            print(f'{what} failed ({self.write_errors[what]} in a row): {err}')
+            if self.write_errors[what] >= self.max_write_errors:
+                raise
+            return False
+        self.write_errors[what] = 0
+        return True
+
+    def held_too_long(self, record):
+        # a record read a flush interval ago has to go out now, however full the batch is
+        return 'rx_ms' in record and time.time() * 1000 - record['rx_ms'] >= self.writer.flush_seconds * 1000
+
+    def process_lines(self):
+        try:
+            self.decode_and_write()
+        except Exception as err:
+            print(f'AIS writer thread stopped: {err}')
+            self.error = err
+            self.running = False
+
+    def decode_and_write(self):
+        start_time = int(time.time())
+        self.writer.open(start_time)
+        records = []
+        batch_start = time.monotonic()
+        # keep draining after a stop so lines already read are not lost
+        while self.running or not self.lines.empty():
+            try:
+                rx_ms, data = self.lines.get(timeout=1)
+                backlog = self.lines.qsize()
+                with self.stats_lock:
+                    if backlog > self.stats['backlog_max']:
+                        self.stats['backlog_max'] = backlog
+                msg = self.handle_line(data, rx_ms=rx_ms)
+                if msg is not None:
+                    records.append(msg)
+            except queue.Empty:
+                pass
+            self.fragments.evict()
+            if not records:
+                batch_start = time.monotonic()
+            elif (len(records) >= self.batch_size or (self.lines.empty() and time.monotonic() - batch_start >= self.batch_seconds)
+                  or self.held_too_long(records[0])):
+                self.guard_io('writing AIS records', self.writer.write, records)
+                records = []
+            # check if the rotation window has elapsed
+            if int(time.time()) >= (start_time + self.rotate_seconds):
+                if records:
+                    self.guard_io('writing AIS records', self.writer.write, records)
+                    records = []
+                self.guard_io('writing AIS stats', self.write_stats, start_time)
+                start_time = int(time.time())
+                self.guard_io('rotating AIS records', self.writer.rotate, start_time)
+            self.guard_io('flushing AIS records', self.writer.tick)
+            if self.publisher is not None:
+                self.publisher.tick()
+        if records:
+            self.writer.write(records)
+        self.writer.close()
+        self.write_stats(start_time)
+        if self.publisher is not None:
+            self.publisher.close()
+
     def main(self):
         SERIAL_PORT = "/dev/serial0"
-        running = True
 
         print("AIS application started!")
         aisc = self.serial_impl(SERIAL_PORT, baudrate=38400, timeout=1)
 
         os.makedirs(self.data_dir, exist_ok=True)
-        start_time = int(time.time())
-        records = []
-        while running:
+        # files left open by a previous run that didn't shut down cleanly
+        self.rename_dotfiles()
+        if self.publisher is not None:
+            self.publisher.start()
+        self.running = True
+        worker = threading.Thread(target=self.process_lines, daemon=True)
+        worker.start()
+        while self.running:
             try:
-                tmp_filename = f'{self.data_dir}/.{self.hostname}-{start_time}-ais.json'
-                # check if 15 minutes have elapsed
-                if int(time.time()) >= (start_time + 900):
-                    self.rename_dotfiles()
-                    start_time = int(time.time())
-                if len(records) > 0:
-                    with open(tmp_filename, 'a') as f:
-                        for record in records:
-                            try:
-                                f.write(f'{json.dumps(record)}\n')
-                            except Exception as e:
-                                f.write('{"error":"'+str(record)+'"}\n')
-                    records = []
-                records = self.getAIS(aisc, records)
-                sleep_time = 1
-                time.sleep(sleep_time)
+                self.read_serial(aisc)
             except KeyboardInterrupt:
-                running = False
-                aisc.close()
-                print("AIS application stopped!")
+                self.running = False
+        worker.join()
+        aisc.close()
+        if self.error is not None:
+            raise self.error
+        print("AIS application stopped!")
 
 
 if __name__ == '__main__':
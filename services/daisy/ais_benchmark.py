@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import resource
+import socket
+import tempfile
+import time
+
+from ais_app import AIS
+
+
+class ReplaySerial:
+    # plays capture lines back like the dAISy HAT would, paced to each line's time on the wire
+
+    def __init__(self, serial_port, baudrate=38400, timeout=1, lines=None, speedup=1.0):
+        self.baudrate = baudrate
+        self.lines = iter(lines or [])
+        self.speedup = speedup
+        self.due = None
+
+    def readline(self):
+        line = next(self.lines, None)
+        if line is None:
+            raise KeyboardInterrupt
+        if self.speedup > 0:
+            # 10 bits per byte on the wire (start, 8 data, stop)
+            now = time.monotonic()
+            if self.due is None:
+                self.due = now
+            self.due += len(line) * 10 / self.baudrate / self.speedup
+            if self.due > now:
+                time.sleep(self.due - now)
+        return line
+
+    def close(self):
+        return
+
+
+class TimedAIS(AIS):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def handle_line(self, data, rx_ms=None):
+        start = time.perf_counter()
+        msg = super().handle_line(data, rx_ms=rx_ms)
+        self.latencies.append(time.perf_counter() - start)
+        return msg
+
+
+def load_capture(paths):
+    lines = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            lines.extend(line for line in f if line.strip())
+    return lines
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def run(lines, baudrate=38400, speedup=0, output_format='json', dedupe=True):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        serial_impl = lambda port, baudrate, timeout: ReplaySerial(port, baudrate, timeout, lines=lines, speedup=speedup)
+        a = TimedAIS(data_dir=tmpdir, serial_impl=serial_impl, dedupe=dedupe, output_format=output_format, rotate_seconds=86400)
+        start = time.monotonic()
+        a.main()
+        elapsed = time.monotonic() - start
+        stats = {}
+        bytes_written = 0
+        for filename in os.listdir(tmpdir):
+            if filename.endswith('-ais-stats.json'):
+                with open(os.path.join(tmpdir, filename)) as f:
+                    stats = json.load(f)
+            else:
+                bytes_written += os.path.getsize(os.path.join(tmpdir, filename))
+    written = stats.get('decoded', 0) - stats.get('suppressed', 0)
+    wire_seconds = sum(len(line) * 10 for line in lines) / baudrate
+    latencies_us = [latency * 1e6 for latency in a.latencies]
+    return {
+        'timestamp': int(time.time()),
+        'hostname': os.getenv("HOSTNAME", socket.gethostname()),
+        'version': os.getenv("VERSION", ""),
+        'output_format': output_format,
+        'dedupe': dedupe,
+        'baudrate': baudrate,
+        'speedup': speedup,
+        'sentences': len(lines),
+        'elapsed_seconds': round(elapsed, 3),
+        'wire_seconds': round(wire_seconds, 3),
+        'sentences_per_second': round(len(lines) / elapsed, 1) if elapsed else 0,
+        'latency_p50_us': round(percentile(latencies_us, 50), 1),
+        'latency_p90_us': round(percentile(latencies_us, 90), 1),
+        'latency_p99_us': round(percentile(latencies_us, 99), 1),
+        'latency_max_us': round(max(latencies_us, default=0), 1),
+        'messages_written': written,
+        'bytes_written': bytes_written,
+        'bytes_per_message': round(bytes_written / written, 1) if written else 0,
+        # kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stats': stats,
+    }
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='replay NMEA captures through the daisy service')
+    parser.add_argument(
+        "captures",
+        help="NMEA capture files, one sentence per line",
+        nargs="+",
+        type=str,
+    )
+    parser.add_argument(
+        "--baudrate",
+        help="serial baud rate to pace the replay at",
+        type=int,
+        default=38400,
+    )
+    parser.add_argument(
+        "--speedup",
+        help="replay this many times faster than the baud rate, 0 replays as fast as possible",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--output_format",
+        help="AIS output format to benchmark",
+        choices=['json', 'segment'],
+        default='json',
+    )
+    parser.add_argument(
+        "--no_dedupe",
+        help="write every position report",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--results",
+        help="append the results as a JSON line to this file to compare releases",
+        type=str,
+        default=None,
+    )
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    results = run(load_capture(args.captures), baudrate=args.baudrate, speedup=args.speedup,
+                  output_format=args.output_format, dedupe=not args.no_dedupe)
+    print(json.dumps(results, indent=2))
+    if args.results:
+        with open(args.results, 'a') as f:
+            f.write(f'{json.dumps(results)}\n')
+
+
+if __name__ == '__main__':
+    main()
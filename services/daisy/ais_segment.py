@@ -0,0 +1,332 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import struct
+import sys
+import time
+
+
+# A segment file is a sequence of length prefixed segments. Each segment holds a
+# batch of decoded messages stored column by column: every key gets one column with
+# the values of the messages that have that key, strings (mmsi, names, enums) are
+# dictionary encoded per segment, coordinates and other fixed point floats are stored
+# as the scaled integers they were decoded from and timestamps as deltas.
+MAGIC = b'AIS1'
+LENGTH = struct.Struct('<I')
+FLOAT = struct.Struct('<d')
+DELTA_KEYS = frozenset(['timestamp', 'rx_ms'])
+
+TAG_INT = 0
+TAG_STR = 1
+TAG_FLOAT = 2
+TAG_DIV10 = 3
+TAG_MUL01 = 4
+TAG_DIV600000 = 5
+TAG_DIV600 = 6
+TAG_NONE = 7
+TAG_BOOL = 8
+TAG_JSON = 9
+
+# fixed point scales used by the AIS decoder, tried in order for each float
+SCALES = (
+    (TAG_DIV600000, lambda v: round(v * 600000), lambda n: n / 600000.0),
+    (TAG_DIV10, lambda v: round(v * 10), lambda n: n / 10.0),
+    (TAG_MUL01, lambda v: round(v * 10), lambda n: n * 0.1),
+    (TAG_DIV600, lambda v: round(v * 600), lambda n: n / 600.0),
+)
+
+
+def write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def write_bytes(out, data):
+    write_varint(out, len(data))
+    out.extend(data)
+
+
+def read_bytes(buf, pos):
+    length, pos = read_varint(buf, pos)
+    return bytes(buf[pos:pos+length]), pos + length
+
+
+def encode_float(value):
+    for tag, scale, unscale in SCALES:
+        n = scale(value)
+        if unscale(n) == value:
+            return tag, n
+    return TAG_FLOAT, value
+
+
+def encode_segment(records):
+    strings = {}
+    keys = {}
+    schemas = {}
+    schema_ids = []
+    columns = []
+
+    for record in records:
+        schema = []
+        for key, value in record.items():
+            key_id = keys.get(key)
+            if key_id is None:
+                key_id = keys[key] = len(keys)
+                columns.append(([], []))
+            schema.append(key_id)
+            tags, values = columns[key_id]
+            if value is None:
+                tags.append(TAG_NONE)
+                values.append(0)
+            elif value is True or value is False:
+                tags.append(TAG_BOOL)
+                values.append(int(value))
+            elif isinstance(value, int):
+                tags.append(TAG_INT)
+                values.append(value)
+            elif isinstance(value, float):
+                tag, n = encode_float(value)
+                tags.append(tag)
+                values.append(n)
+            else:
+                if not isinstance(value, str):
+                    tags.append(TAG_JSON)
+                    value = json.dumps(value, default=str)
+                else:
+                    tags.append(TAG_STR)
+                string_id = strings.get(value)
+                if string_id is None:
+                    string_id = strings[value] = len(strings)
+                values.append(string_id)
+        schema = tuple(schema)
+        schema_id = schemas.get(schema)
+        if schema_id is None:
+            schema_id = schemas[schema] = len(schemas)
+        schema_ids.append(schema_id)
+
+    out = bytearray(MAGIC)
+    write_varint(out, len(records))
+    write_varint(out, len(strings))
+    for string in strings:
+        write_bytes(out, string.encode('utf-8'))
+    write_varint(out, len(keys))
+    for key in keys:
+        write_bytes(out, key.encode('utf-8'))
+    write_varint(out, len(schemas))
+    for schema in schemas:
+        write_varint(out, len(schema))
+        for key_id in schema:
+            write_varint(out, key_id)
+    for schema_id in schema_ids:
+        write_varint(out, schema_id)
+    for key, (tags, values) in zip(keys, columns):
+        # a column where every value has the same type only stores the tag once
+        if tags.count(tags[0]) == len(tags):
+            out.append(1)
+            out.append(tags[0])
+        else:
+            out.append(0)
+            out.extend(tags)
+        delta = key in DELTA_KEYS
+        previous = 0
+        for tag, value in zip(tags, values):
+            if tag == TAG_FLOAT:
+                out.extend(FLOAT.pack(value))
+            elif tag == TAG_INT:
+                if delta:
+                    value, previous = value - previous, value
+                write_varint(out, zigzag(value))
+            elif tag == TAG_STR or tag == TAG_JSON or tag == TAG_BOOL:
+                write_varint(out, value)
+            elif tag != TAG_NONE:
+                write_varint(out, zigzag(value))
+    return LENGTH.pack(len(out)) + out
+
+
+def decode_segment(buf):
+    if buf[:4] != MAGIC:
+        raise ValueError(f'not an AIS segment: {bytes(buf[:4])}')
+    pos = 4
+    count, pos = read_varint(buf, pos)
+    num, pos = read_varint(buf, pos)
+    strings = []
+    for _ in range(num):
+        string, pos = read_bytes(buf, pos)
+        strings.append(string.decode('utf-8'))
+    num, pos = read_varint(buf, pos)
+    keys = []
+    for _ in range(num):
+        key, pos = read_bytes(buf, pos)
+        keys.append(key.decode('utf-8'))
+    num, pos = read_varint(buf, pos)
+    schemas = []
+    for _ in range(num):
+        length, pos = read_varint(buf, pos)
+        schema = []
+        for _ in range(length):
+            key_id, pos = read_varint(buf, pos)
+            schema.append(key_id)
+        schemas.append(schema)
+    schema_ids = []
+    for _ in range(count):
+        schema_id, pos = read_varint(buf, pos)
+        schema_ids.append(schemas[schema_id])
+
+    lengths = [0] * len(keys)
+    for schema in schema_ids:
+        for key_id in schema:
+            lengths[key_id] += 1
+    columns = []
+    for key, length in zip(keys, lengths):
+        if buf[pos]:
+            tags = bytes([buf[pos+1]]) * length
+            pos += 2
+        else:
+            tags = bytes(buf[pos+1:pos+1+length])
+            pos += 1 + length
+        delta = key in DELTA_KEYS
+        previous = 0
+        values = []
+        for tag in tags:
+            if tag == TAG_FLOAT:
+                value = FLOAT.unpack_from(buf, pos)[0]
+                pos += FLOAT.size
+            elif tag == TAG_NONE:
+                value = None
+            else:
+                value, pos = read_varint(buf, pos)
+                if tag == TAG_INT:
+                    value = unzigzag(value)
+                    if delta:
+                        value += previous
+                        previous = value
+                elif tag == TAG_STR:
+                    value = strings[value]
+                elif tag == TAG_JSON:
+                    value = json.loads(strings[value])
+                elif tag == TAG_BOOL:
+                    value = bool(value)
+                else:
+                    n = unzigzag(value)
+                    for scale_tag, _, unscale in SCALES:
+                        if scale_tag == tag:
+                            value = unscale(n)
+                            break
+            values.append(value)
+        columns.append(iter(values))
+
+    records = []
+    for schema in schema_ids:
+        records.append({keys[key_id]: next(columns[key_id]) for key_id in schema})
+    return records
+
+
+def read_segments(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + LENGTH.size <= len(data):
+        length = LENGTH.unpack_from(data, pos)[0]
+        pos += LENGTH.size
+        if pos + length > len(data):
+            # a segment that was cut short by a crash
+            print(f'truncated segment at offset {pos - LENGTH.size} in {path}')
+            break
+        for record in decode_segment(memoryview(data)[pos:pos+length]):
+            yield record
+        pos += length
+
+
+def to_jsonl(path, out):
+    records = 0
+    for record in read_segments(path):
+        out.write(f'{json.dumps(record)}\n')
+        records += 1
+    return records
+
+
+def benchmark(records, batch_size=256):
+    start = time.process_time()
+    jsonl_bytes = sum(len(f'{json.dumps(record)}\n') for record in records)
+    jsonl_cpu = time.process_time() - start
+    start = time.process_time()
+    segment_bytes = 0
+    for i in range(0, len(records), batch_size):
+        segment_bytes += len(encode_segment(records[i:i+batch_size]))
+    segment_cpu = time.process_time() - start
+    count = max(len(records), 1)
+    return {
+        'messages': len(records),
+        'jsonl_bytes_per_msg': jsonl_bytes / count,
+        'jsonl_encode_us_per_msg': jsonl_cpu * 1e6 / count,
+        'segment_bytes_per_msg': segment_bytes / count,
+        'segment_encode_us_per_msg': segment_cpu * 1e6 / count,
+    }
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='convert AIS segment files to JSONL')
+    parser.add_argument(
+        "segments",
+        help="segment files to convert",
+        nargs="+",
+        type=str,
+    )
+    parser.add_argument(
+        "--output",
+        help="write JSONL here instead of stdout",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--benchmark",
+        help="compare bytes and encode CPU per message against JSONL instead of converting",
+        action="store_true",
+    )
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    if args.benchmark:
+        records = []
+        for path in args.segments:
+            records.extend(read_segments(path))
+        print(json.dumps(benchmark(records)))
+        return
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, 'w')
+    try:
+        for path in args.segments:
+            to_jsonl(path, out)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
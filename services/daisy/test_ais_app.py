@@ -1,8 +1,24 @@
 import json
 import glob
 import os
+import socket
 import tempfile
-from ais_app import AIS
+import time
+from ais_app import AIS, FragmentAssembler, Publisher, RecordWriter, StateCache, TrafficSummary, last_gps_fix, parse_thresholds
+from ais_benchmark import load_capture, run
+from ais_segment import benchmark, encode_segment, decode_segment, read_segments
+
+
+CAPTURE = [
+    "!AIVDM,1,1,,B,15M67FC000G?ufbE`FepT@3n00Sa,0*5C\r\n",
+    "!AIVDM,1,1,,A,13HOI:0P0000VOHLCnHQKwvL05Ip,0*23\r\n",
+    "!AIVDM,1,1,,A,403Ovl@000Htt<tSF0l4Q@100`Pq,0*28\r\n",
+    "!AIVDM,1,1,,B,B5NJ;PP005l4ot5Isbl03wsUkP06,0*75\r\n",
+]
+TYPE5 = [
+    "!AIVDM,2,1,1,A,55?MbV02;H;s<HtKR20EHE:0@T4@Dn2222222216L961O5Gf0NSQEp6ClRp8,0*1C\r\n",
+    "!AIVDM,2,2,1,A,88888888880,2*25\r\n",
+]
 
 
 class FakeSerial:
@@ -24,16 +40,318 @@ class FakeSerial:
         return
 
 
+class ReplaySerial:
+
+    def __init__(self, serial_port, baudrate, timeout, lines=CAPTURE * 500):
+        self.baudrate = baudrate
+        self.lines = iter(lines)
+
+    def readline(self):
+        line = next(self.lines, None)
+        if line is None:
+            raise KeyboardInterrupt
+        return line.encode('ascii')
+
+    def close(self):
+        return
+
+
 def test_main():
     with tempfile.TemporaryDirectory() as tmpdir:
         a = AIS(data_dir=tmpdir, serial_impl=FakeSerial)
         a.main()
         a.rename_dotfiles()
-        json_files = glob.glob(os.path.join(tmpdir, '*json'))
+        json_files = glob.glob(os.path.join(tmpdir, '*-ais.json'))
         assert len(json_files) == 1
         with open(json_files[0]) as f:
             record = json.load(f)
+        assert record['timestamp'] == record['rx_ms'] // 1000
         del record['timestamp']
+        del record['rx_ms']
         assert record == {
                 'type': 4, 'repeat': 0, 'mmsi': '003669713', 'year': 0, 'month': 0, 'day': 0, 'hour': 24, 'minute': 60, 'second': 60,
                 'accuracy': 0, 'lon': 181.0, 'lat': 91.0, 'epfd': 'GPS', 'raim': 0, 'radio': 165945}
+
+
+def test_replay_keeps_up():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        a = AIS(data_dir=tmpdir, serial_impl=ReplaySerial, dedupe=False)
+        start = time.time()
+        a.main()
+        elapsed = time.time() - start
+        a.rename_dotfiles()
+        records = 0
+        for json_file in glob.glob(os.path.join(tmpdir, '*-ais.json')):
+            with open(json_file) as f:
+                records += sum(1 for line in f)
+        assert records == len(CAPTURE) * 500
+        with open(glob.glob(os.path.join(tmpdir, '*-ais-stats.json'))[0]) as f:
+            stats = json.load(f)
+        assert stats['read'] == records
+        assert stats['decoded'] == records
+        assert stats['dropped'] == 0
+        assert stats['channels']['A']['messages'] + stats['channels']['B']['messages'] == records
+        assert stats['latency_ms']['p50'] <= stats['latency_ms']['max']
+        assert stats['last_rx_ms'] > 0
+        # 10 bits per byte on the wire at 38400 baud
+        wire_time = sum(len(line) * 10 for line in CAPTURE * 500) / 38400
+        assert elapsed < wire_time
+
+
+def test_write_errors():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        a = AIS(data_dir=tmpdir, serial_impl=ReplaySerial, dedupe=False, max_write_errors=3)
+        writes = []
+
+        def fail_twice(records):
+            writes.append(len(records))
+            if len(writes) <= 2:
+                raise OSError(28, 'No space left on device')
+            RecordWriter.write(a.writer, records)
+
+        a.writer.write = fail_twice
+        a.main()
+        # the two failed batches are dropped and counted, the rest written
+        assert len(writes) > 2
+        a.rename_dotfiles()
+        with open(glob.glob(os.path.join(tmpdir, '*-ais-stats.json'))[0]) as f:
+            assert json.load(f)['write_errors'] == 2
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        a = AIS(data_dir=tmpdir, serial_impl=ReplaySerial, dedupe=False, max_write_errors=3)
+
+        def fail(records):
+            raise OSError(28, 'No space left on device')
+
+        a.writer.write = fail
+        # failing every time stops the reader too, and main raises so docker restarts the container
+        try:
+            a.main()
+        except OSError as err:
+            assert err.errno == 28
+        else:
+            assert False, 'main did not raise'
+        assert not a.running
+
+
+def test_fragment_assembler():
+    assembler = FragmentAssembler(max_groups=2, max_age=5)
+    first, second = [AIS.parse(line) for line in TYPE5]
+    assert assembler.add(first, now=0) is None
+    msg = AIS.decode_message(assembler.add(second, now=1))
+    assert msg['type'] == 5
+    assert msg['shipname'] == 'EVER DIADEM'
+    assert msg['destination'] == 'NEW YORK'
+    # second fragment without its first
+    assert assembler.add(AIS.parse(TYPE5[1]), now=2) is None
+    # first fragment that never completes
+    assert assembler.add(AIS.parse(TYPE5[0]), now=3) is None
+    assembler.evict(now=9)
+    assert not assembler.groups
+    assert assembler.stats == {'completed': 1, 'expired': 1, 'corrupt': 1}
+    # a single sentence message passes straight through
+    single = AIS.parse(CAPTURE[0])
+    assert assembler.add(single) is single
+
+
+def test_prefilter():
+    a = AIS(skip_types=[5])
+    assert a.prefilter(CAPTURE[0]) == CAPTURE[0].strip().encode('ascii')
+    assert a.prefilter(CAPTURE[0].replace('*5C', '*5D')) is None
+    assert a.prefilter('!AIVDM,1,1,,B,15M67FC000G') is None
+    assert a.prefilter('\x00\xff garbage') is None
+    # both fragments of a skipped type are dropped before decoding
+    assert a.prefilter(TYPE5[0]) is None
+    assert a.prefilter(TYPE5[1]) is None
+    assert not a.skipped_groups
+    assert a.stats['rejected_checksum'] == 1
+    assert a.stats['rejected_framing'] == 2
+    assert a.stats['skipped_type'] == 2
+
+
+def test_replay_dedupe():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gps_dir = os.path.join(tmpdir, 'gps')
+        os.mkdir(gps_dir)
+        with open(os.path.join(gps_dir, 'host-1-gps.txt'), 'w') as f:
+            f.write('  latitude: 37.8 degrees\n  longitude: -122.34 degrees\n')
+        a = AIS(data_dir=tmpdir, serial_impl=ReplaySerial, gps_dir=gps_dir)
+        a.main()
+        a.rename_dotfiles()
+        with open(glob.glob(os.path.join(tmpdir, '*-ais.json'))[0]) as f:
+            mmsis = [json.loads(line)['mmsi'] for line in f]
+        assert len(mmsis) == len(CAPTURE)
+        with open(glob.glob(os.path.join(tmpdir, '*-ais-stats.json'))[0]) as f:
+            stats = json.load(f)
+        assert stats['suppressed'] == len(CAPTURE) * 499
+        traffic = stats['traffic']
+        assert traffic['unique_mmsi'] == len(CAPTURE)
+        assert traffic['messages'] == len(CAPTURE) * 500
+        assert traffic['types'] == {'1': 1000, '4': 500, '18': 500}
+        assert traffic['closest_mmsi'] == '366053209'
+        assert traffic['closest_m'] < 500
+        assert len(json.dumps(traffic)) < 500
+
+
+def test_state_cache():
+    cache = StateCache(max_vessels=2, keyframe_seconds=60)
+    msg = AIS.decode(CAPTURE[0])
+    msg['timestamp'] = 0
+    assert cache.should_write(dict(msg))
+    assert not cache.should_write(dict(msg, timestamp=10))
+    assert not cache.should_write(dict(msg, timestamp=20, lat=msg['lat'] + 0.0001))
+    assert cache.should_write(dict(msg, timestamp=30, lat=msg['lat'] + 0.001))
+    assert cache.should_write(dict(msg, timestamp=40, lat=msg['lat'] + 0.001, course=msg['course'] + 10))
+    # periodic keyframe
+    assert cache.should_write(dict(msg, timestamp=100, lat=msg['lat'] + 0.001, course=msg['course'] + 10))
+    # least recently seen vessel is evicted
+    cache.should_write(dict(msg, mmsi='1'))
+    cache.should_write(dict(msg, mmsi='2'))
+    assert (msg['mmsi'], 1) not in cache.vessels
+    # non position messages always pass
+    assert cache.should_write({'type': 5, 'mmsi': '1', 'timestamp': 0})
+
+
+def test_dedupe_config():
+    assert parse_thresholds('') == {}
+    assert parse_thresholds('position_m=50, keyframe_seconds=600') == {'position_m': 50, 'keyframe_seconds': 600}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        a = AIS(data_dir=tmpdir, dedupe_max_vessels=8, dedupe_thresholds={'position_m': 100})
+        assert (a.state_cache.max_vessels, a.state_cache.position_m, a.state_cache.speed) == (8, 100, 0.5)
+        os.environ['AIS_DEDUPE_THRESHOLDS'] = 'speed=2'
+        try:
+            assert AIS(data_dir=tmpdir).state_cache.speed == 2
+        finally:
+            del os.environ['AIS_DEDUPE_THRESHOLDS']
+
+
+def test_segment_round_trip():
+    records = [AIS.decode(line) for line in CAPTURE] + [AIS.decode_message(AIS.parse(TYPE5[0]))]
+    records.append({'error': None, 'flag': True, 'odd': 0.123456789, 'nested': [1, 2]})
+    for i, record in enumerate(records):
+        record['timestamp'] = 1670000000 + i
+    segment = encode_segment(records)
+    assert decode_segment(segment[4:]) == records
+    assert [json.dumps(r) for r in decode_segment(segment[4:])] == [json.dumps(r) for r in records]
+
+
+def test_batch_hold():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        a = AIS(data_dir=tmpdir, output_format='segment', flush_seconds=5)
+        now_ms = int(time.time() * 1000)
+        assert not a.held_too_long({'rx_ms': now_ms - 1000})
+        assert a.held_too_long({'rx_ms': now_ms - 5000})
+
+
+def test_segment_output():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        a = AIS(data_dir=tmpdir, serial_impl=ReplaySerial, dedupe=False, output_format='segment')
+        a.main()
+        a.rename_dotfiles()
+        segment_files = glob.glob(os.path.join(tmpdir, '*-ais.seg'))
+        assert len(segment_files) == 1
+        records = list(read_segments(segment_files[0]))
+        assert len(records) == len(CAPTURE) * 500
+        assert records[0]['mmsi'] == '366053209'
+        results = benchmark(records)
+        assert results['segment_bytes_per_msg'] * 4 < results['jsonl_bytes_per_msg']
+
+
+def test_record_writer():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = RecordWriter(tmpdir, 'host', flush_seconds=60)
+        writer.open(1)
+        writer.write([{'a': 1}])
+        # still buffered, nothing flushed yet
+        assert os.path.getsize(os.path.join(tmpdir, '.host-1-ais.json')) == 0
+        writer.flush()
+        assert os.path.getsize(os.path.join(tmpdir, '.host-1-ais.json')) > 0
+        # another service's dotfile in the same directory is left alone
+        with open(os.path.join(tmpdir, '.other'), 'w') as f:
+            f.write('other')
+        writer.rotate(2)
+        # a record read a flush interval ago is flushed on the next tick, even right after a flush
+        writer.write([{'a': 2, 'rx_ms': int(time.time() * 1000) - 60000}])
+        assert os.path.getsize(os.path.join(tmpdir, '.host-2-ais.json')) > 0
+        writer.close()
+        assert sorted(os.listdir(tmpdir)) == ['.other', 'host-1-ais.json', 'host-2-ais.json']
+
+
+def test_benchmark():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        capture = os.path.join(tmpdir, 'capture.nmea')
+        with open(capture, 'w') as f:
+            f.write(''.join(CAPTURE * 50 + TYPE5))
+        lines = load_capture([capture])
+        assert len(lines) == len(CAPTURE) * 50 + len(TYPE5)
+        results = run(lines, speedup=0, dedupe=False)
+        assert results['messages_written'] == len(CAPTURE) * 50 + 1
+        assert results['stats']['dropped'] == 0
+        assert results['latency_p50_us'] <= results['latency_p99_us'] <= results['latency_max_us']
+        assert results['bytes_per_message'] > 0
+        assert results['peak_rss_kb'] > 0
+        # paced at 100x the baud rate the replay can't finish before the last line is sent
+        results = run(lines, speedup=100)
+        assert results['elapsed_seconds'] >= results['wire_seconds'] / 100
+
+
+def test_traffic_summary():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        assert last_gps_fix(tmpdir) is None
+        assert last_gps_fix(os.path.join(tmpdir, 'missing')) is None
+    summary = TrafficSummary(grid_deg=0.1, max_cells=1)
+    for line in CAPTURE:
+        summary.add(AIS.decode(line))
+    result = summary.summary()
+    assert result['closest_m'] is None
+    # the base station with no position isn't in the grid
+    assert len(summary.positions) == 3
+    assert result['grid'] == [[37.8, -122.3, 2]]
+
+
+def test_publisher():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'run', 'ais.sock')
+        publisher = Publisher(path, max_pending=4096)
+        publisher.start()
+        fast = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        fast.connect(path)
+        fast.setblocking(False)
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        slow.connect(path)
+        publisher.tick()
+        assert len(publisher.subscribers) == 2
+        received = b''
+        for i in range(5000):
+            publisher.publish({'mmsi': str(i), 'padding': 'x' * 200})
+            try:
+                while True:
+                    received += fast.recv(65536)
+            except BlockingIOError:
+                pass
+        lines = received.splitlines()
+        assert len(lines) == 5000
+        assert json.loads(lines[-1])['mmsi'] == '4999'
+        stats = {s['id']: s for s in publisher.stats()}
+        assert stats[1]['sent'] == 5000 and stats[1]['dropped'] == 0
+        # the subscriber that never reads loses messages instead of stalling the publisher
+        assert stats[2]['dropped'] > 0
+        slow.close()
+        fast.close()
+        publisher.close()
+        assert not os.path.exists(path)
+
+
+def test_publish_decoded():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'ais.sock')
+        a = AIS(data_dir=tmpdir, serial_impl=ReplaySerial, socket_path=path)
+        a.publisher.start()
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(path)
+        a.publisher.tick()
+        a.handle_line(CAPTURE[0])
+        with conn.makefile('r') as f:
+            assert json.loads(f.readline())['mmsi'] == '366053209'
+        conn.close()
+        a.publisher.close()
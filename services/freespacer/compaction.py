@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+import gzip
+import json
+import logging
+import os
+import time
+
+
+def closed_files(scan, dir_path, after_seconds, now):
+    # scan(dir_path) lists (ctime, path, bytes), never the newest, readers like status-updater open that one
+    files = sorted(scan(dir_path)) if os.path.isdir(dir_path) else []
+    return [f for f in files[:-1] if now - f[0] >= after_seconds]
+
+
+def rewrite(file_name, new_name, write):
+    # written as a dotfile so eviction leaves it alone, the mtime is kept, returns bytes saved
+    st = os.stat(file_name)
+    tmp_name = os.path.join(os.path.dirname(new_name), f'.{os.path.basename(new_name)}.tmp')
+    try:
+        with open(tmp_name, 'wb') as f:
+            write(f)
+        os.utime(tmp_name, ns=(st.st_atime_ns, st.st_mtime_ns))
+        new_size = os.stat(tmp_name).st_blocks * 512
+        os.rename(tmp_name, new_name)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    if new_name != file_name:
+        os.remove(file_name)
+    return st.st_blocks * 512 - new_size
+
+
+def compress_closed(policy, scan, now=None):
+    # gzip closed JSON files in directories with compress_after_hours, returns bytes saved
+    if now is None:
+        now = time.time()
+    saved = 0
+    for dir_path, rule in policy['dirs'].items():
+        if rule['compress_after_seconds'] is None:
+            continue
+        for _, file_name, _ in closed_files(scan, dir_path, rule['compress_after_seconds'], now):
+            if not file_name.endswith('.json'):
+                continue
+
+            def write(f, file_name=file_name):
+                with open(file_name, 'rb') as src, gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as dst:
+                    for chunk in iter(lambda: src.read(64 * 1024), b''):
+                        dst.write(chunk)
+
+            try:
+                saved += rewrite(file_name, f'{file_name}.gz', write)
+            except OSError as err:
+                logging.info("failed to compress %s: %s", file_name, err)
+    if saved:
+        logging.info("compressed closed JSON files, saved %u bytes", saved)
+    return saved
+
+
+def downsample_records(lines, interval):
+    # one datapoint per interval seconds in each {"target": ..., "datapoints": [[value, timestamp_ms], ...]}
+    # line, other lines are kept as they are, returns the lines and how many datapoints were dropped
+    out = []
+    dropped = 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+            datapoints = record['datapoints']
+            buckets = set()
+            kept = []
+            for datapoint in datapoints:
+                bucket = int(datapoint[1]) // (interval * 1000)
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    kept.append(datapoint)
+        except (ValueError, KeyError, TypeError, IndexError):
+            out.append(line)
+            continue
+        dropped += len(datapoints) - len(kept)
+        record['datapoints'] = kept
+        out.append(f'{json.dumps(record)}\n'.encode())
+    return out, dropped
+
+
+def downsample_old(policy, scan, now=None):
+    # thin old datapoints in directories with downsample_after_hours, returns bytes saved
+    if now is None:
+        now = time.time()
+    saved = 0
+    for dir_path, rule in policy['dirs'].items():
+        if rule['downsample_after_seconds'] is None:
+            continue
+        for _, file_name, _ in closed_files(scan, dir_path, rule['downsample_after_seconds'], now):
+            if not file_name.endswith(('.json', '.json.gz')):
+                continue
+            opener = gzip.open if file_name.endswith('.gz') else open
+            try:
+                with opener(file_name, 'rb') as f:
+                    lines, dropped = downsample_records(f, rule['downsample_seconds'])
+                if not dropped:
+                    continue
+
+                def write(f, lines=lines, opener=opener):
+                    if opener is open:
+                        f.writelines(lines)
+                        return
+                    with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as dst:
+                        dst.writelines(lines)
+
+                saved += rewrite(file_name, file_name, write)
+            except (OSError, EOFError) as err:
+                logging.info("failed to downsample %s: %s", file_name, err)
+    if saved:
+        logging.info("downsampled old datapoints, saved %u bytes", saved)
+    return saved
+
+
+def request_upload(request_file):
+    # s3-upload marks its bulk job due when this appears, it still waits for the link and battery
+    with open(request_file, 'w') as f:
+        f.write(f'{int(time.time())}\n')
+    logging.info("asked s3-upload for an early upload window through %s", request_file)
@@ -1,37 +1,416 @@
 #!/usr/bin/python3
 
 import argparse
-import glob
+import collections
+import heapq
+import json
 import logging
+import math
 import os
-import re
-import subprocess
+import select
+import sqlite3
 import time
 
+from compaction import compress_closed, downsample_old, request_upload
+from usage_tracker import UsageTracker
 
-def make_free_space(path, min_used_pct):
 
-    def enough_free():
-        df_out = subprocess.check_output(["/bin/df", "--output=pcent", path])
-        df_match = re.findall(r'\d+', "".join(df_out.decode('utf8').splitlines()))
-        if not df_match:
-            raise ValueError(f"unexpected df output: {df_out}")
-        used_pct = int(df_match[0])
-        logging.info("used space now %u%%", used_pct)
-        return (used_pct < min_used_pct)
+def disk_usage(path):
+    # one statvfs instead of forking df, used and available bytes the way df counts them
+    st = os.statvfs(path)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    avail = st.f_bavail * st.f_frsize
+    return used, avail
 
+
+def used_pct(used, avail):
+    # df rounds up
+    if not used + avail:
+        return 0
+    return math.ceil(used * 100 / (used + avail))
+
+
+def scan_files(path):
+    # (ctime, path, bytes on disk) from one scandir walk, dot entries are still being written
+    files = []
+    dirs = [path]
+    while dirs:
+        try:
+            with os.scandir(dirs.pop()) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            # compaction rewrites files keeping their mtime, only the ctime is new
+                            files.append((min(st.st_ctime, st.st_mtime), entry.path, st.st_blocks * 512))
+                    except FileNotFoundError:
+                        # archived, compacted or evicted since it was listed
+                        continue
+        except FileNotFoundError:
+            # removed again before we got to it
+            continue
+    return files
+
+
+def plan_eviction(files, used, avail, min_used_pct):
+    # files are tuples ending in (path, bytes) popped off a heap, so (ctime, path, bytes) goes oldest first
+    heapq.heapify(files)
+    plan = []
+    # deleting a file moves its blocks from used to available, so the total stays the same
+    while files and used_pct(used, avail) >= min_used_pct:
+        *_, file_name, size = heapq.heappop(files)
+        plan.append((file_name, size))
+        used -= size
+        avail += size
+    return plan
+
+
+def load_uploaded(manifest):
+    # paths s3-upload has confirmed are in the bucket, one query into a set, nothing if it can't be read
+    if not manifest:
+        return frozenset()
+    try:
+        db = sqlite3.connect(f'file:{manifest}?mode=ro', uri=True)
+        try:
+            return frozenset(row[0] for row in db.execute('SELECT path FROM uploads'))
+        finally:
+            db.close()
+    except sqlite3.Error as err:
+        logging.info("can't read upload manifest %s, treating every file as not uploaded: %s", manifest, err)
+        return frozenset()
+
+
+def read_stats(stats_file):
+    stats = {'uploaded_files': 0, 'uploaded_bytes': 0, 'lost_files': 0, 'lost_bytes': 0}
+    try:
+        with open(stats_file) as f:
+            stats.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return stats
+
+
+def write_stats(stats_file, stats):
+    # status-updater reads it, so it's replaced whole
+    stats['updated'] = int(time.time())
+    tmp_file = os.path.join(os.path.dirname(stats_file), f'.{os.path.basename(stats_file)}.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(stats, f)
+    os.replace(tmp_file, stats_file)
+    return stats
+
+
+def record_evictions(stats_file, removed):
+    # (bytes, uploaded) per removed file, never uploaded is data lost and counted apart
+    stats = read_stats(stats_file)
+    for size, uploaded in removed:
+        kind = 'uploaded' if uploaded else 'lost'
+        stats[f'{kind}_files'] += 1
+        stats[f'{kind}_bytes'] += size
+    return write_stats(stats_file, stats)
+
+
+def load_policy(filename):
+    # per directory priority (lowest evicted first), minimum age, quota and compaction, see retention.json,
+    # archives maps a directory of upload tars to the root of the types they're kept like
+    with open(filename) as f:
+        config = json.load(f)
+
+    def rule(entry):
+        default = config.get('default', {})
+        quota_mb = entry.get('quota_mb', default.get('quota_mb'))
+        compress_hours = entry.get('compress_after_hours')
+        downsample_hours = entry.get('downsample_after_hours')
+        return {
+            'priority': entry.get('priority', default.get('priority', 0)),
+            'min_age_seconds': entry.get('min_age_hours', default.get('min_age_hours', 0)) * 3600,
+            'quota_bytes': None if quota_mb is None else quota_mb * 1024 * 1024,
+            'compress_after_seconds': None if compress_hours is None else compress_hours * 3600,
+            'downsample_after_seconds': None if downsample_hours is None else downsample_hours * 3600,
+            'downsample_seconds': entry.get('downsample_seconds', 60),
+        }
+
+    return {
+        'roots': config['roots'],
+        'default': rule({}),
+        'dirs': {os.path.normpath(dir_path): rule(entry) for dir_path, entry in config.get('dirs', {}).items()},
+        'archives': {os.path.normpath(archive_dir): os.path.normpath(root)
+                     for archive_dir, root in config.get('archives', {}).items()},
+    }
+
+
+def type_dir(roots, file_name):
+    # a file belongs to the top level directory under its root, /flash/telemetry/ais/x/y -> /flash/telemetry/ais
+    for root in roots:
+        relative = os.path.relpath(file_name, root)
+        if not relative.startswith('..'):
+            parts = relative.split(os.sep)
+            return os.path.join(root, parts[0]) if len(parts) > 1 else os.path.normpath(root)
+    return os.path.dirname(file_name)
+
+
+def policy_dir(policy, file_name):
+    # tars are named {telemetry}-{hostname}-..., /flash/s3/uploaded/ais-x.tar -> /flash/s3/ais as UploadPool.priority does
+    for archive_dir in policy.get('archives', {}):
+        if not os.path.relpath(file_name, archive_dir).startswith('..'):
+            return os.path.join(archive_dir, os.path.basename(file_name).split('-')[0])
+    return type_dir(policy['roots'], file_name)
+
+
+def policy_rule(policy, dir_path):
+    if dir_path in policy['dirs']:
+        return policy['dirs'][dir_path]
+    archive_dir, telemetry = os.path.split(dir_path)
+    if archive_dir not in policy.get('archives', {}):
+        return policy['default']
+    rule = policy['dirs'].get(os.path.join(policy['archives'][archive_dir], telemetry), policy['default'])
+    # the type's priority and minimum age, its quota is for the telemetry it's kept under
+    return dict(rule, quota_bytes=None)
+
+
+def plan_policy_eviction(policy, used, avail, min_used_pct, now=None, files=None, uploaded=frozenset()):
+    # (path, bytes, reason) for quota evictions, then by priority and age until below min_used_pct,
+    # uploaded files go first at any age, the rest never younger than their minimum age
+    if now is None:
+        now = time.time()
+    if files is None:
+        files = [f for root in policy['roots'] if os.path.isdir(root) for f in scan_files(root)]
+    by_dir = {}
+    for ctime, file_name, size in files:
+        by_dir.setdefault(policy_dir(policy, file_name), []).append((ctime, file_name, size))
+    plan = []
+    candidates = []
+    for dir_path, dir_files in by_dir.items():
+        rule = policy_rule(policy, dir_path)
+        total = sum(f[2] for f in dir_files)
+        eligible = []
+        young = 0
+        for ctime, file_name, size in dir_files:
+            shipped = file_name in uploaded
+            if not shipped and now - ctime < rule['min_age_seconds']:
+                young += 1
+                continue
+            # False sorts first, uploaded files before the rest
+            eligible.append((not shipped, ctime, file_name, size))
+        if young:
+            logging.info("keeping %u files in %s younger than %us", young, dir_path, rule['min_age_seconds'])
+        eligible.sort()
+        for not_shipped, ctime, file_name, size in eligible:
+            if rule['quota_bytes'] is not None and total > rule['quota_bytes']:
+                plan.append((file_name, size, f'{dir_path} over its {rule["quota_bytes"]} byte quota'))
+                total -= size
+                used -= size
+                avail += size
+                continue
+            candidates.append((not_shipped, rule['priority'], ctime, dir_path, file_name, size))
+    heapq.heapify(candidates)
+    while candidates and used_pct(used, avail) >= min_used_pct:
+        _, priority, ctime, dir_path, file_name, size = heapq.heappop(candidates)
+        plan.append((file_name, size, f'disk over {min_used_pct}%, {dir_path} priority {priority}, {int(now - ctime)}s old'))
+        used -= size
+        avail += size
+    if used_pct(used, avail) >= min_used_pct:
+        logging.info("can't get below %u%% without evicting files younger than their minimum age", min_used_pct)
+    return plan
+
+
+def make_free_space(path, min_used_pct, policy=None, manifest=None, stats_file=None):
+    used, avail = disk_usage(path)
+    logging.info("used space now %u%%", used_pct(used, avail))
     removed = []
-    if not enough_free():
-        files = sorted([(f, os.lstat(f)) for f in glob.glob(os.path.join(path, '*'), recursive=True) if os.path.isfile(f)], key=lambda x: x[1].st_ctime)
-        for file_name, file_stat in files:
+    if policy is None and used_pct(used, avail) < min_used_pct:
+        return removed
+    uploaded = load_uploaded(manifest)
+    if policy is not None:
+        # quotas apply whatever the usage, so there's always a plan to make
+        plan = plan_policy_eviction(policy, used, avail, min_used_pct, uploaded=uploaded)
+    else:
+        files = [(file_name not in uploaded, ctime, file_name, size) for ctime, file_name, size in scan_files(path)]
+        plan = [(file_name, size, 'oldest') for file_name, size in plan_eviction(files, used, avail, min_used_pct)]
+    evicted = []
+    for file_name, size, reason in plan:
+        try:
             os.remove(file_name)
-            removed.append(file_name)
-            logging.info("removed %s, size %u", file_name, file_stat.st_size)
-            if enough_free():
-                break
+        except FileNotFoundError:
+            continue
+        removed.append(file_name)
+        evicted.append((size, file_name in uploaded))
+        logging.info("removed %s, size %u, %s: %s", file_name, size,
+                     'uploaded' if file_name in uploaded else 'NOT uploaded', reason)
+    lost = [size for size, shipped in evicted if not shipped]
+    if lost:
+        logging.warning("evicted %u files (%u bytes) that were never uploaded", len(lost), sum(lost))
+    if evicted and stats_file:
+        stats = record_evictions(stats_file, evicted)
+        logging.info("data lost to eviction so far: %u files, %u bytes", stats['lost_files'], stats['lost_bytes'])
+    used, avail = disk_usage(path)
+    logging.info("removed %u files, used space now %u%%", len(removed), used_pct(used, avail))
     return removed
 
 
+class FillForecast:
+    # least squares fill rate over a sliding window of samples, when min_used_pct is less than
+    # horizon_hours away compress, downsample, then ask s3-upload for a window, before any eviction
+
+    def __init__(self, roots, horizon_hours=24, request_file=None, window_seconds=24*3600, sample_seconds=600,
+                 time_sec=time.time):
+        self.roots = roots
+        self.horizon_hours = horizon_hours
+        self.request_file = request_file
+        self.window_seconds = window_seconds
+        self.sample_seconds = sample_seconds
+        self.time_sec = time_sec
+        self.samples = collections.deque()
+
+    def due(self):
+        return not self.samples or self.time_sec() - self.samples[-1][0] >= self.sample_seconds
+
+    def sample(self, used, sizes):
+        # used bytes on the disk and (path, bytes) of every file under the roots
+        now = self.time_sec()
+        by_type = collections.Counter()
+        for file_name, size in sizes:
+            by_type[type_dir(self.roots, file_name)] += size
+        self.samples.append((now, used, by_type))
+        while now - self.samples[0][0] > self.window_seconds:
+            self.samples.popleft()
+
+    def rate(self):
+        # bytes per second, None until the samples span sample_seconds
+        if len(self.samples) < 2 or self.samples[-1][0] - self.samples[0][0] < self.sample_seconds:
+            return None
+        mean_t = sum(t for t, _, _ in self.samples) / len(self.samples)
+        mean_used = sum(used for _, used, _ in self.samples) / len(self.samples)
+        var = sum((t - mean_t) ** 2 for t, _, _ in self.samples)
+        cov = sum((t - mean_t) * (used - mean_used) for t, used, _ in self.samples)
+        return cov / var
+
+    def type_rates(self):
+        # archiving and eviction shrink a directory, only the growth is written
+        span = self.samples[-1][0] - self.samples[0][0]
+        written = collections.Counter()
+        for (_, _, before), (_, _, after) in zip(self.samples, list(self.samples)[1:]):
+            for dir_path, size in after.items():
+                written[dir_path] += max(0, size - before.get(dir_path, 0))
+        return {dir_path: round(size * 3600 / span) for dir_path, size in written.items()}
+
+    def hours_to(self, used, avail, pct):
+        rate = self.rate()
+        target = (used + avail) * pct / 100
+        if used >= target:
+            return 0
+        if not rate or rate <= 0:
+            return None
+        return round((target - used) / rate / 3600, 1)
+
+    def forecast(self, used, avail, min_used_pct):
+        rate = self.rate()
+        return {
+            'used_pct': used_pct(used, avail),
+            'bytes_per_hour': None if rate is None else round(rate * 3600),
+            'hours_to_threshold': self.hours_to(used, avail, min_used_pct),
+            'hours_to_full': self.hours_to(used, avail, 100),
+            'bytes_per_hour_by_type': self.type_rates() if rate is not None else {},
+        }
+
+    def check(self, path, min_used_pct, sizes, policy=None, manifest=None, stats_file=None):
+        # sizes() is only called when a sample is due, files in the manifest count as free space
+        # since eviction takes them before anything lossy is needed
+        if not self.due():
+            return None
+        used, avail = disk_usage(path)
+        files = list(sizes())
+        self.sample(used, files)
+        uploaded = load_uploaded(manifest)
+        reclaimable = sum(size for file_name, size in files if file_name in uploaded)
+        report = self.forecast(used - reclaimable, avail + reclaimable, min_used_pct)
+        report['used_pct'] = used_pct(used, avail)
+        report['reclaimable_bytes'] = reclaimable
+        steps = []
+        hours = report['hours_to_threshold']
+        if hours is not None and hours < self.horizon_hours:
+            logging.info("disk forecast to reach %u%% in %.1f hours, making room early", min_used_pct, hours)
+            actions = []
+            if policy is not None:
+                actions.extend([('compress', compress_closed), ('downsample', downsample_old)])
+            for name, action in actions:
+                if action(policy, scan_files):
+                    steps.append(name)
+                used, avail = disk_usage(path)
+                hours = self.hours_to(used - reclaimable, avail + reclaimable, min_used_pct)
+                if hours is None or hours >= self.horizon_hours:
+                    break
+            else:
+                if self.request_file:
+                    request_upload(self.request_file)
+                    steps.append('upload')
+            report['hours_to_threshold'] = hours
+            report['hours_to_full'] = self.hours_to(used - reclaimable, avail + reclaimable, 100)
+            report['used_pct'] = used_pct(used, avail)
+        report['steps'] = steps
+        logging.info("fill forecast: %s", json.dumps(report))
+        if stats_file:
+            stats = read_stats(stats_file)
+            stats['forecast'] = report
+            write_stats(stats_file, stats)
+        return report
+
+
+def watch_free_space(path, min_used_pct, low_water_pct=None, wait_time=300, settle_time=1, wakeups=None, policy=None,
+                     manifest=None, stats_file=None, forecaster=None, tracker=None):
+    # usage is the bytes the tracker sees plus whatever else was on the disk at the last statvfs,
+    # refreshed every wait_time with the policy's quotas, evictions go down to low_water_pct
+    if low_water_pct is None:
+        low_water_pct = min_used_pct
+    if tracker is None:
+        tracker = UsageTracker(policy['roots'] if policy else [path])
+
+    def evict(pct):
+        for file_name in make_free_space(path, pct, policy=policy, manifest=manifest, stats_file=stats_file):
+            tracker.forget(file_name)
+
+    used, avail = disk_usage(path)
+    capacity = used + avail
+    other = used - tracker.total
+    deadline = time.monotonic() + wait_time
+    last_read = time.monotonic() - settle_time
+    count = 0
+    try:
+        while wakeups is None or count < wakeups:
+            readable, _, _ = select.select([tracker.fd], [], [], max(0, deadline - time.monotonic()))
+            count += 1
+            if readable:
+                # let writes queue up and take them in one read, at most once per settle_time
+                time.sleep(max(0, min(last_read + settle_time, deadline) - time.monotonic()))
+                tracker.read_events()
+                last_read = time.monotonic()
+            if time.monotonic() >= deadline:
+                if policy is not None:
+                    evict(min_used_pct)
+                used, avail = disk_usage(path)
+                capacity = used + avail
+                other = used - tracker.total
+                deadline = time.monotonic() + wait_time
+            if forecaster is not None:
+                forecaster.check(path, min_used_pct, lambda: tracker.sizes.items(), policy=policy,
+                                 manifest=manifest, stats_file=stats_file)
+            estimate = other + tracker.total
+            if used_pct(estimate, capacity - estimate) < min_used_pct:
+                continue
+            logging.info("estimated usage %u%% crossed %u%%", used_pct(estimate, capacity - estimate), min_used_pct)
+            evict(low_water_pct)
+            used, avail = disk_usage(path)
+            capacity = used + avail
+            other = used - tracker.total
+    finally:
+        tracker.close()
+    return count
+
+
 def argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -50,6 +429,47 @@ def argument_parser():
         type=int,
         default=300,
     )
+    parser.add_argument(
+        "--inotify",
+        help="watch path with inotify and only check when usage crosses min_used_pct, polling every wait_time as a fallback",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--low_water_pct",
+        help="with --inotify, evict down to this percentage once min_used_pct is crossed",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--policy",
+        help="JSON retention policy with a quota, priority and minimum age per directory, like retention.json",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--forecast_hours",
+        help="hours ahead to forecast reaching min_used_pct, and compact or ask for an early upload (0 disables)",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--upload_request",
+        help="file that asks s3-upload for an early upload window, like /flash/s3/.upload-now",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--manifest",
+        help="s3-upload manifest database, files it has uploaded are evicted first, like /flash/s3/.manifest.db",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--stats_file",
+        help="JSON file to keep running totals of evicted files in, uploaded and lost",
+        type=str,
+        default=None,
+    )
     return parser
 
 
@@ -57,8 +477,31 @@ def argument_parser():
 def main():
     logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(message)s")
     args = argument_parser().parse_args()
+    policy = None
+    if args.policy:
+        policy = load_policy(args.policy)
+    roots = policy['roots'] if policy else [args.path]
+    forecaster = None
+    if args.forecast_hours:
+        forecaster = FillForecast(roots, horizon_hours=args.forecast_hours, request_file=args.upload_request)
+    if args.inotify:
+        make_free_space(args.path, args.min_used_pct, policy=policy, manifest=args.manifest,
+                        stats_file=args.stats_file)
+        try:
+            tracker = UsageTracker(roots)
+        except OSError as err:
+            logging.info("inotify unavailable, polling instead: %s", err)
+        else:
+            watch_free_space(args.path, args.min_used_pct, low_water_pct=args.low_water_pct, wait_time=args.wait_time,
+                             policy=policy, manifest=args.manifest, stats_file=args.stats_file, forecaster=forecaster,
+                             tracker=tracker)
     while True:
-        make_free_space(args.path, args.min_used_pct)
+        make_free_space(args.path, args.min_used_pct, policy=policy, manifest=args.manifest,
+                        stats_file=args.stats_file)
+        if forecaster is not None:
+            forecaster.check(args.path, args.min_used_pct,
+                             lambda: [(f[1], f[2]) for root in roots if os.path.isdir(root) for f in scan_files(root)],
+                             policy=policy, manifest=args.manifest, stats_file=args.stats_file)
         logging.info("waiting for %u seconds for next run", args.wait_time)
         time.sleep(args.wait_time)
 
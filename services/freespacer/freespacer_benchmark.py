@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+
+from freespacer_app import disk_usage, plan_eviction, scan_files
+
+
+def make_tree(path, count, dirs=10):
+    for d in range(dirs):
+        os.mkdir(os.path.join(path, f'type{d}'))
+    for i in range(count):
+        with open(os.path.join(path, f'type{i % dirs}', f'host-{i}.json'), 'w') as f:
+            f.write('{}\n')
+
+
+def run(count, evict_fraction=0.5, statvfs_samples=20):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        make_tree(tmpdir, count)
+        results = {'files': count}
+
+        start = time.monotonic()
+        files = scan_files(tmpdir)
+        results['scan_seconds'] = round(time.monotonic() - start, 3)
+        results['files_found'] = len(files)
+        # the old glob(path/*) only looked at the top level
+        results['glob_files_found'] = len([f for f in glob.glob(os.path.join(tmpdir, '*')) if os.path.isfile(f)])
+
+        # pretend the disk is exactly at its target and needs evict_fraction of the files gone
+        total = sum(f[2] for f in files)
+        used = total
+        avail = 0
+        start = time.monotonic()
+        plan = plan_eviction(files, used, avail, 100 * (1 - evict_fraction) + 1)
+        results['plan_seconds'] = round(time.monotonic() - start, 3)
+        results['planned'] = len(plan)
+
+        start = time.monotonic()
+        for file_name, _ in plan:
+            os.remove(file_name)
+        results['delete_seconds'] = round(time.monotonic() - start, 3)
+
+        # the old loop forked df once per deletion, busybox df in the image can't be timed the same way
+        start = time.monotonic()
+        for _ in range(statvfs_samples):
+            disk_usage(tmpdir)
+        statvfs_seconds = (time.monotonic() - start) / statvfs_samples
+        results['statvfs_ms'] = round(statvfs_seconds * 1000, 3)
+    return results
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='benchmark freespacer planning on a generated tree')
+    parser.add_argument(
+        "--files",
+        help="number of files to generate",
+        type=int,
+        default=100000,
+    )
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    print(json.dumps(run(args.files), indent=2))
+
+
+if __name__ == '__main__':
+    main()
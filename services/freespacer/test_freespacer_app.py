@@ -1,9 +1,19 @@
 #!/usr/bin/python3
 
+import contextlib
+import gzip
+import json
 import os
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
-from freespacer_app import make_free_space, argument_parser
+from unittest import mock
+import freespacer_app
+from compaction import compress_closed, downsample_old
+from freespacer_app import make_free_space, argument_parser, FillForecast, load_policy, plan_eviction, plan_policy_eviction, record_evictions, scan_files, watch_free_space
+from usage_tracker import UsageTracker
 
 
 class apptest(unittest.TestCase):
@@ -24,6 +34,290 @@ class apptest(unittest.TestCase):
             self.assertEquals([], make_free_space(tmpdir, 100))
             self.assertTrue(os.path.exists(test_file))
 
+    def test_scan_files_race(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            kept = os.path.join(tmpdir, 'kept.json')
+            gone = os.path.join(tmpdir, 'gone.json')
+            for file_name in (kept, gone):
+                with open(file_name, 'w') as f:
+                    f.write(file_name)
+            scandir = os.scandir
+
+            def racing_scandir(path):
+                entries = list(scandir(path))
+                # s3-upload archives it between the listing and the stat
+                os.remove(gone)
+                return contextlib.nullcontext(entries)
+
+            with mock.patch('os.scandir', racing_scandir):
+                self.assertEqual([kept], [f[1] for f in scan_files(tmpdir)])
+            self.assertEqual([], scan_files(os.path.join(tmpdir, 'missing')))
+
+    def test_plan_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'ais', 'sub'))
+            for name in ('ais/a.json', 'ais/sub/b.json', 'top.json', 'ais/.writing.json'):
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(name)
+            files = scan_files(tmpdir)
+            self.assertEqual(
+                sorted(os.path.join(tmpdir, name) for name in ('ais/a.json', 'ais/sub/b.json', 'top.json')),
+                sorted(f[1] for f in files))
+            removed = make_free_space(tmpdir, 0)
+            self.assertEqual(3, len(removed))
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'ais/.writing.json')))
+        # 4 of 10 blocks used, getting under 25% needs the two oldest files gone
+        files = [(3, 'c', 1), (1, 'a', 1), (2, 'b', 1), (4, 'd', 1)]
+        self.assertEqual([('a', 1), ('b', 1)], plan_eviction(files, 4, 6, 25))
+        self.assertEqual([], plan_eviction([(1, 'a', 1)], 4, 6, 50))
+
+    def test_plan_policy_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            policy_file = os.path.join(tmpdir, 'retention.json')
+            with open(policy_file, 'w') as f:
+                json.dump({
+                    'roots': ['/flash/telemetry'],
+                    'default': {'priority': 1},
+                    'dirs': {
+                        '/flash/telemetry/status': {'priority': 9, 'quota_mb': 2},
+                        '/flash/telemetry/ais': {'priority': 5, 'min_age_hours': 36},
+                    },
+                }, f)
+            policy = load_policy(policy_file)
+        rule = policy['dirs']['/flash/telemetry/status']
+        self.assertEqual((9, 0, 2 * 1024 * 1024, None),
+                         (rule['priority'], rule['min_age_seconds'], rule['quota_bytes'], rule['compress_after_seconds']))
+        mb = 1024 * 1024
+        day = 86400
+        now = 10 * day
+        # one file a day per directory, the last written today
+        files = []
+        for dir_name, count in (('status', 4), ('ais', 3), ('hydrophone/x', 3)):
+            for i in range(count):
+                files.append((now - (count - 1 - i) * day, f'/flash/telemetry/{dir_name}/{i}.json', mb))
+
+        def plan(used, avail, min_used_pct):
+            return [file_name for file_name, _, _ in
+                    plan_policy_eviction(policy, used * mb, avail * mb, min_used_pct, now=now, files=files)]
+
+        # status is over its quota by two files whatever the usage
+        self.assertEqual(['/flash/telemetry/status/0.json', '/flash/telemetry/status/1.json'], plan(10, 90, 50))
+        # then hydrophone (default priority) before ais, oldest first, and ais only when it's old enough
+        self.assertEqual(
+            ['/flash/telemetry/status/0.json', '/flash/telemetry/status/1.json',
+             '/flash/telemetry/hydrophone/x/0.json', '/flash/telemetry/hydrophone/x/1.json',
+             '/flash/telemetry/hydrophone/x/2.json', '/flash/telemetry/ais/0.json'],
+            plan(10, 0, 45))
+        # nothing younger than 36 hours in ais, even when the target can't be reached
+        everything = plan(10, 0, 1)
+        self.assertEqual(['/flash/telemetry/status/2.json', '/flash/telemetry/status/3.json'], everything[-2:])
+        self.assertNotIn('/flash/telemetry/ais/1.json', everything)
+        self.assertNotIn('/flash/telemetry/ais/2.json', everything)
+        # tars take their type's priority and minimum age from the name, uploaded or not
+        policy['roots'].append('/flash/s3')
+        policy['archives'] = {'/flash/s3': '/flash/telemetry'}
+        files = [(now - 2 * day, '/flash/s3/status-host-0.tar', mb),
+                 (now - 2 * day, '/flash/s3/uploaded/hydrophone-host-0.tar', mb),
+                 (now - 2 * day, '/flash/s3/ais-host-0.tar', mb), (now, '/flash/s3/ais-host-1.tar', mb)]
+        self.assertEqual(
+            ['/flash/s3/uploaded/hydrophone-host-0.tar', '/flash/s3/ais-host-0.tar', '/flash/s3/status-host-0.tar'],
+            plan(4, 0, 1))
+
+    def test_upload_aware_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            names = ('old.json', 'new.json', 'newest.json')
+            for name in names:
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(name)
+            manifest = os.path.join(tmpdir, '.manifest.db')
+            db = sqlite3.connect(manifest)
+            db.execute('CREATE TABLE uploads (sha256 TEXT PRIMARY KEY, size INTEGER, uploaded REAL, key TEXT, path TEXT)')
+            db.execute('INSERT INTO uploads VALUES (?, ?, ?, ?, ?)', ('0' * 64, 8, 0, 'newest.json', os.path.join(tmpdir, 'newest.json')))
+            db.commit()
+            db.close()
+            stats_file = os.path.join(tmpdir, '.freespacer.json')
+            removed = make_free_space(tmpdir, 0, manifest=manifest, stats_file=stats_file)
+            # the uploaded file goes first even though it's the newest
+            self.assertEqual(os.path.join(tmpdir, 'newest.json'), removed[0])
+            self.assertEqual(sorted(os.path.join(tmpdir, name) for name in names), sorted(removed))
+            with open(stats_file) as f:
+                stats = json.load(f)
+            self.assertEqual((1, 2), (stats['uploaded_files'], stats['lost_files']))
+            stats = record_evictions(stats_file, [(100, False)])
+            self.assertEqual(3, stats['lost_files'])
+        # not uploaded files are still taken oldest first
+        self.assertEqual([('a', 1)], plan_eviction([(True, 1, 'a', 1), (True, 2, 'b', 1)], 2, 2, 50))
+        files = [(1, '/flash/telemetry/hydrophone/old.flac', 1), (2, '/flash/telemetry/ais/new.json', 1)]
+        policy = {'roots': ['/flash/telemetry'], 'default': {'priority': 1, 'min_age_seconds': 0, 'quota_bytes': None},
+                  'dirs': {'/flash/telemetry/ais': {'priority': 5, 'min_age_seconds': 3600, 'quota_bytes': None}}}
+        # ais is younger than its minimum age and more precious, but shipped
+        plan = plan_policy_eviction(policy, 2, 2, 50, now=10, files=files, uploaded={'/flash/telemetry/ais/new.json'})
+        self.assertEqual(['/flash/telemetry/ais/new.json'], [f[0] for f in plan])
+
+    def test_fill_forecast(self):
+        now = [0]
+        forecaster = FillForecast(['/flash/telemetry'], time_sec=lambda: now[0])
+        for i in range(7):
+            now[0] = i * 600
+            # 10 bytes a second, ais writes 100 bytes a sample and hydrophone is archived half way
+            hydrophone = 5000 if i < 3 else 1000
+            forecaster.sample(1000000 + i * 6000, [('/flash/telemetry/ais/a.json', i * 100),
+                                                   ('/flash/telemetry/hydrophone/b.flac', hydrophone)])
+        self.assertAlmostEqual(10, forecaster.rate())
+        self.assertEqual({'/flash/telemetry/ais': 600, '/flash/telemetry/hydrophone': 0}, forecaster.type_rates())
+        # 36000 bytes to go at 10 a second
+        self.assertEqual(1.0, forecaster.hours_to(64000, 36000, 100))
+        self.assertEqual(0, forecaster.hours_to(64000, 36000, 50))
+        report = forecaster.forecast(64000, 36000, 90)
+        self.assertEqual((36000, 0.7, 1.0), (report['bytes_per_hour'], report['hours_to_threshold'], report['hours_to_full']))
+        # already past 80%, but half the disk is uploaded and eviction frees it before anything lossy
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, '.manifest.db')
+            db = sqlite3.connect(manifest)
+            db.execute('CREATE TABLE uploads (sha256 TEXT, size INTEGER, uploaded REAL, key TEXT, path TEXT)')
+            db.execute('INSERT INTO uploads VALUES (?, ?, ?, ?, ?)', ('0' * 64, 50, 0, 'a.tar', '/flash/s3/uploaded/a.tar'))
+            db.commit()
+            db.close()
+            request_file = os.path.join(tmpdir, '.upload-now')
+            sizes = [('/flash/s3/uploaded/a.tar', 50), ('/flash/telemetry/ais/a.json', 40)]
+            with mock.patch('freespacer_app.disk_usage', return_value=(90, 10)):
+                report = FillForecast(['/flash/telemetry'], request_file=request_file).check(
+                    '/flash', 80, lambda: sizes, manifest=manifest)
+                self.assertEqual((90, 50, None, []), (report['used_pct'], report['reclaimable_bytes'],
+                                                      report['hours_to_threshold'], report['steps']))
+                report = FillForecast(['/flash/telemetry'], request_file=request_file).check('/flash', 80, lambda: sizes)
+                self.assertEqual((0, ['upload']), (report['hours_to_threshold'], report['steps']))
+
+    def test_compaction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sensors = os.path.join(tmpdir, 'sensors')
+            os.makedirs(sensors)
+            old_file = os.path.join(sensors, 'host-1-sensehat.json')
+            new_file = os.path.join(sensors, 'host-2-sensehat.json')
+            for file_name in (old_file, new_file):
+                with open(file_name, 'w') as f:
+                    # a reading a second for ten minutes, timestamps in ms
+                    datapoints = [[20, (960 + i) * 1000] for i in range(600)]
+                    f.write(json.dumps({'target': 'temperature_c', 'datapoints': datapoints}) + '\n')
+                    f.write('not json\n')
+            os.utime(old_file, (time.time() - 7200,) * 2)
+            mtime = os.stat(old_file).st_mtime
+            rule = {'priority': 1, 'min_age_seconds': 0, 'quota_bytes': None, 'compress_after_seconds': 3600,
+                    'downsample_after_seconds': 3600, 'downsample_seconds': 60}
+            policy = {'roots': [tmpdir], 'default': rule, 'dirs': {sensors: rule}}
+            compress_closed(policy, scan_files)
+            # the newest file is left for readers like status-updater
+            self.assertEqual(['host-1-sensehat.json.gz', 'host-2-sensehat.json'], sorted(os.listdir(sensors)))
+            self.assertEqual(mtime, os.stat(old_file + '.gz').st_mtime)
+            downsample_old(policy, scan_files)
+            with gzip.open(old_file + '.gz', 'rt') as f:
+                lines = f.readlines()
+            self.assertEqual(10, len(json.loads(lines[0])['datapoints']))
+            self.assertEqual('not json\n', lines[1])
+            # already at the usage asked for, so every step runs and s3-upload is asked for a window
+            request_file = os.path.join(tmpdir, '.upload-now')
+            stats_file = os.path.join(tmpdir, '.freespacer.json')
+            forecaster = FillForecast([tmpdir], request_file=request_file)
+            report = forecaster.check(tmpdir, 0, lambda: [], policy=policy, stats_file=stats_file)
+            self.assertEqual(0, report['hours_to_threshold'])
+            self.assertEqual('upload', report['steps'][-1])
+            self.assertTrue(os.path.exists(request_file))
+            with open(stats_file) as f:
+                self.assertEqual(report, json.load(f)['forecast'])
+            # not again until the next sample is due
+            self.assertIsNone(forecaster.check(tmpdir, 0, lambda: [], policy=policy, stats_file=stats_file))
+
+    def test_usage_tracker(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'old.json'), 'w') as f:
+                f.write('x' * 5000)
+            tracker = UsageTracker([tmpdir])
+            self.assertEqual(os.stat(os.path.join(tmpdir, 'old.json')).st_blocks * 512, tracker.total)
+            os.makedirs(os.path.join(tmpdir, 'hydrophone'))
+            tracker.read_events()
+            # the new directory is watched too
+            with open(os.path.join(tmpdir, 'hydrophone', '.rec.flac'), 'wb') as f:
+                for _ in range(10):
+                    f.write(os.urandom(4096))
+                    f.flush()
+            os.rename(os.path.join(tmpdir, 'hydrophone', '.rec.flac'), os.path.join(tmpdir, 'hydrophone', 'rec.flac'))
+            os.remove(os.path.join(tmpdir, 'old.json'))
+            self.assertGreater(tracker.read_events(), 0)
+            self.assertEqual([os.path.join(tmpdir, 'hydrophone', 'rec.flac')], list(tracker.sizes))
+            self.assertEqual(os.stat(os.path.join(tmpdir, 'hydrophone', 'rec.flac')).st_blocks * 512, tracker.total)
+            tracker.close()
+
+    def test_watch_free_space(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test_file = os.path.join(tmpdir, 'test.raw')
+            # nothing happens, one fallback check
+            self.assertEqual(1, watch_free_space(tmpdir, 100, wait_time=0.1, settle_time=0, wakeups=1))
+            writer = threading.Timer(0.1, lambda: open(test_file, 'w').close())
+            writer.start()
+            # the write wakes it up and any usage crosses 0%
+            watch_free_space(tmpdir, 0, wait_time=5, settle_time=0, wakeups=1)
+            writer.join()
+            self.assertFalse(os.path.exists(test_file))
+
+    def test_watch_quota(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            status_dir = os.path.join(tmpdir, 'status')
+            os.mkdir(status_dir)
+            policy_file = os.path.join(tmpdir, 'retention.json')
+            with open(policy_file, 'w') as f:
+                # room for two and a half files of one block each
+                quota = 2.5 * os.statvfs(tmpdir).f_frsize
+                json.dump({'roots': [tmpdir], 'dirs': {status_dir: {'quota_mb': quota / (1024 * 1024)}}}, f)
+            policy = load_policy(policy_file)
+            files = [os.path.join(status_dir, f'{i}.json') for i in range(4)]
+
+            stop = threading.Event()
+
+            def write_files():
+                for i, file_name in enumerate(files):
+                    with open(file_name, 'w') as f:
+                        f.write('x' * 1000)
+                    os.utime(file_name, (i, i))
+                # and keep writing elsewhere so select never times out
+                while not stop.wait(0.01):
+                    with open(os.path.join(tmpdir, 'hydrophone.raw'), 'w') as f:
+                        f.write('x')
+
+            writer = threading.Thread(target=write_files)
+            writer.start()
+            try:
+                # usage never crosses 100%, only the deadline check can enforce the quota
+                watch_free_space(tmpdir, 100, wait_time=0.3, settle_time=0.05, wakeups=20, policy=policy)
+            finally:
+                stop.set()
+                writer.join()
+            self.assertEqual([False, False, True, True], [os.path.exists(file_name) for file_name in files])
+
+    def test_watch_deadline(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stop = threading.Event()
+
+            def trickle():
+                i = 0
+                while not stop.wait(0.01):
+                    with open(os.path.join(tmpdir, f'{i % 10}.raw'), 'w') as f:
+                        f.write('x')
+                    i += 1
+
+            writer = threading.Thread(target=trickle)
+            writer.start()
+            try:
+                with mock.patch('freespacer_app.disk_usage', wraps=freespacer_app.disk_usage) as usage:
+                    started = time.monotonic()
+                    watch_free_space(tmpdir, 100, wait_time=0.2, settle_time=0.05, wakeups=20)
+                    elapsed = time.monotonic() - started
+            finally:
+                stop.set()
+                writer.join()
+            # events never stop, but reads are rate limited and the statvfs still runs every wait_time
+            self.assertGreaterEqual(elapsed, 19 * 0.05)
+            self.assertGreaterEqual(usage.call_count, int(elapsed / 0.2))
+
 
 if __name__ == '__main__':
     unittest.main()
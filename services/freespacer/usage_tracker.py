@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT = struct.Struct('iIII')
+
+
+class UsageTracker:
+    # running total of the bytes under paths from inotify events, dotfiles use the disk too
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.sizes = {}
+        self.total = 0
+        try:
+            for path in paths:
+                self.scan(path)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def watch(self, dir_path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch {dir_path} failed')
+        self.watches[wd] = dir_path
+
+    def update(self, file_path):
+        try:
+            st = os.lstat(file_path)
+        except FileNotFoundError:
+            self.forget(file_path)
+            return
+        size = st.st_blocks * 512
+        self.total += size - self.sizes.get(file_path, 0)
+        self.sizes[file_path] = size
+
+    def forget(self, file_path):
+        self.total -= self.sizes.pop(file_path, 0)
+
+    def scan(self, dir_path):
+        dirs = [dir_path]
+        while dirs:
+            dir_path = dirs.pop()
+            try:
+                self.watch(dir_path)
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        else:
+                            self.update(entry.path)
+            except FileNotFoundError:
+                # removed again before we got to it
+                continue
+
+    def rescan(self):
+        for wd in self.watches:
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches = {}
+        self.sizes = {}
+        self.total = 0
+        for path in self.paths:
+            self.scan(path)
+
+    def read_events(self):
+        # a file written many times since the last read is only stat'd once
+        changed = set()
+        events = 0
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, pos)
+                name = data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\0')
+                pos += EVENT.size + length
+                events += 1
+                if mask & IN_Q_OVERFLOW:
+                    logging.info("inotify queue overflowed, rescanning %s", ', '.join(self.paths))
+                    self.rescan()
+                    return events
+                dir_path = self.watches.get(wd)
+                if dir_path is None:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_IGNORED):
+                    self.watches.pop(wd, None)
+                    continue
+                file_path = os.path.join(dir_path, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.scan(file_path)
+                    elif mask & IN_MOVED_FROM:
+                        for known in [f for f in self.sizes if f.startswith(file_path + os.sep)]:
+                            self.forget(known)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changed.discard(file_path)
+                    self.forget(file_path)
+                else:
+                    changed.add(file_path)
+        for file_path in changed:
+            self.update(file_path)
+        return events
+
+    def close(self):
+        os.close(self.fd)
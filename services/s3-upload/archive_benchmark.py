@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+from archiver import archive_dir
+from s3_app import CODECS, parse_codec
+
+
+def make_files(filedir, count, size):
+    line = '{"target": "battery_charge", "datapoints": [[87, 1700000000]]}\n'
+    data = (line * (size // len(line) + 1))[:size]
+    for i in range(count):
+        with open(os.path.join(filedir, f'host-{1700000000 + i}-power.json'), 'w') as f:
+            f.write(data)
+
+
+def usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def run_tar_argv(filedir, tarfile, codec, level):
+    # the old tar_dir, every filename on the tar command line
+    tar_args = ['/usr/bin/tar', '--sort=name', '-C', filedir]
+    if CODECS[codec][0] is not None:
+        tar_args.extend(['-I', f'{CODECS[codec][0]} -{level}'])
+    tar_args.extend(['-cf', tarfile])
+    tar_args.extend(sorted(os.listdir(filedir)))
+    try:
+        proc = subprocess.Popen(tar_args)
+    except OSError as err:
+        # E2BIG, the argument list is too long
+        return {'error': str(err)}
+    _, status, child = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {'returncode': proc.returncode, 'peak_rss_kb': child.ru_maxrss}
+
+
+def run_in_process(filedir, tarfile, codec, level):
+    entries = archive_dir(filedir, tarfile, codec=codec, level=level, remove=False)
+    return {'entries': entries, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run(count, size, codec, level):
+    results = {'files': count, 'file_bytes': size, 'codec': codec, 'level': level}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filedir = os.path.join(tmpdir, 'power')
+        os.mkdir(filedir)
+        make_files(filedir, count, size)
+        for name, method in (('tar_argv', run_tar_argv), ('in_process', run_in_process)):
+            tarfile = os.path.join(tmpdir, f'{name}{CODECS[codec][1]}')
+            cpu = usage()
+            start = time.monotonic()
+            result = method(filedir, tarfile, codec, level)
+            result['wall_seconds'] = round(time.monotonic() - start, 3)
+            result['cpu_seconds'] = round(usage() - cpu, 3)
+            if os.path.exists(tarfile):
+                result['archive_bytes'] = os.path.getsize(tarfile)
+                os.remove(tarfile)
+            results[name] = result
+    return results
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='compare archiving with tar on the command line to in process')
+    parser.add_argument(
+        "--files",
+        help="number of telemetry files to archive",
+        type=int,
+        default=50000,
+    )
+    parser.add_argument(
+        "--size",
+        help="bytes per file",
+        type=int,
+        default=1024,
+    )
+    parser.add_argument(
+        "--codec",
+        help="codec:level to archive with",
+        type=str,
+        default='xz:6',
+    )
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    codec, level = parse_codec(args.codec)
+    print(json.dumps(run(args.files, args.size, codec, level), indent=2))
+
+
+if __name__ == '__main__':
+    main()
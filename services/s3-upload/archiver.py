@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+import grp
+import gzip
+import io
+import lzma
+import os
+import pwd
+import stat
+import struct
+import subprocess
+import tarfile
+import threading
+
+
+BLOCK = 512
+# name, mode, uid, gid, size, mtime, checksum, type, linkname, magic+version, uname, gname,
+# devmajor, devminor, prefix, padding
+USTAR = struct.Struct('100s8s8s8s12s12s8s1s100s8s32s32s8s8s155s12s')
+
+
+def ustar_header(name, mode, uid, gid, size, mtime, typeflag, linkname, uname, gname):
+    # a plain ustar header, or None if a field doesn't fit and tarfile has to build a GNU one
+    name = name.encode('utf-8', 'surrogateescape')
+    linkname = linkname.encode('utf-8', 'surrogateescape')
+    uname = uname.encode('utf-8', 'surrogateescape')
+    gname = gname.encode('utf-8', 'surrogateescape')
+    if (len(name) > 100 or len(linkname) > 100 or len(uname) > 32 or len(gname) > 32
+            or uid >= 0o7777777 or gid >= 0o7777777 or size >= 0o77777777777 or not 0 <= mtime < 0o77777777777):
+        return None
+    header = bytearray(USTAR.pack(
+        name, b'%07o\0' % mode, b'%07o\0' % uid, b'%07o\0' % gid, b'%011o\0' % size, b'%011o\0' % mtime,
+        b' ' * 8, typeflag, linkname, b'ustar\x0000', uname, gname, b'', b'', b'', b''))
+    header[148:156] = b'%06o\0 ' % sum(header)
+    return bytes(header)
+
+
+def scan_tree(filedir, relative=''):
+    # (relative path, DirEntry) in name order, dot entries are in progress and skipped with everything under them
+    with os.scandir(os.path.join(filedir, relative)) as it:
+        entries = sorted((entry for entry in it if not entry.name.startswith('.')), key=lambda entry: entry.name)
+    for entry in entries:
+        path = os.path.join(relative, entry.name)
+        yield path, entry
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_tree(filedir, path)
+
+
+class ProcessCompressor(io.RawIOBase):
+    # compresses through a command like zstd -19 -c, writing its output to out from a thread
+
+    def __init__(self, out, args):
+        super().__init__()
+        self.out = out
+        self.error = None
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.thread = threading.Thread(target=self.copy, daemon=True)
+        self.thread.start()
+
+    def copy(self):
+        for chunk in iter(lambda: self.proc.stdout.read(64 * 1024), b''):
+            if self.error is not None:
+                # keep draining so the compressor can't block on a full pipe
+                continue
+            try:
+                self.out.write(chunk)
+            except Exception as err:
+                self.error = err
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.proc.stdin.close()
+        self.thread.join()
+        returncode = self.proc.wait()
+        if self.error is not None:
+            raise self.error
+        if returncode:
+            raise OSError(f'{" ".join(self.proc.args)} returned {returncode}')
+
+
+def compressor(out, codec, level):
+    # file object that compresses into out, or None to write out uncompressed
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level)
+    if codec == 'xz':
+        return lzma.LZMAFile(out, 'w', preset=level)
+    if codec == 'zstd':
+        try:
+            import zstandard  # pylint: disable=import-error # pytype: disable=import-error
+        except ImportError:
+            return ProcessCompressor(out, ['zstd', f'-{level}', '-q', '-c'])
+        return zstandard.ZstdCompressor(level=level).stream_writer(out, closefd=False)
+    return None
+
+
+class ArchiveWriter:
+    # tar in process so there's no argv to outgrow, headers are packed directly and only entries that
+    # don't fit a ustar header fall back to tarfile's GNU headers
+
+    def __init__(self, out, codec='none', level=None, chunk_size=64*1024):
+        self.compressed = compressor(out, codec, level)
+        self.out = self.compressed or out
+        self.chunk_size = chunk_size
+        self.names = {}
+        self.entries = 0
+        self.bytes = 0
+        self.written = 0
+        # headers and small files are batched, every compressor call has its own overhead
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        self.written += len(data)
+        if len(self.buffer) >= self.chunk_size:
+            self.out.write(self.buffer)
+            self.buffer = bytearray()
+
+    def owner(self, table, entry_id):
+        # tarfile looks the owner up again for every file
+        key = (table, entry_id)
+        if key not in self.names:
+            try:
+                self.names[key] = (pwd.getpwuid if table == 'user' else grp.getgrgid)(entry_id)[0]
+            except KeyError:
+                self.names[key] = ''
+        return self.names[key]
+
+    def header(self, arcname, st, typeflag, size=0, linkname=''):
+        uname = self.owner('user', st.st_uid)
+        gname = self.owner('group', st.st_gid)
+        mtime = int(st.st_mtime)
+        header = ustar_header(arcname, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid, size, mtime,
+                              typeflag, linkname, uname, gname)
+        if header is None:
+            info = tarfile.TarInfo(arcname)
+            info.mode = stat.S_IMODE(st.st_mode)
+            info.uid, info.gid, info.uname, info.gname = st.st_uid, st.st_gid, uname, gname
+            info.size, info.mtime, info.type, info.linkname = size, mtime, typeflag, linkname
+            header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+        self.write(header)
+
+    def add(self, path, arcname, st):
+        if stat.S_ISDIR(st.st_mode):
+            self.header(arcname.rstrip('/') + '/', st, tarfile.DIRTYPE)
+        elif stat.S_ISLNK(st.st_mode):
+            self.header(arcname, st, tarfile.SYMTYPE, linkname=os.readlink(path))
+        elif stat.S_ISREG(st.st_mode):
+            with open(path, 'rb') as f:
+                self.header(arcname, st, tarfile.REGTYPE, size=st.st_size)
+                remaining = st.st_size
+                while remaining:
+                    data = f.read(min(remaining, self.chunk_size))
+                    if not data:
+                        # like GNU tar, a file that shrank while being read is padded
+                        print(f'{path} shrank by {remaining} bytes, padding with zeros')
+                        data = bytes(min(remaining, self.chunk_size))
+                    self.write(data)
+                    remaining -= len(data)
+            if st.st_size % BLOCK:
+                self.write(bytes(BLOCK - st.st_size % BLOCK))
+            self.bytes += st.st_size
+        else:
+            return False
+        self.entries += 1
+        return True
+
+    def close(self):
+        # two zero blocks end the archive, padded to whole 10 KiB records like tar does
+        self.write(bytes(2 * BLOCK))
+        if self.written % tarfile.RECORDSIZE:
+            self.write(bytes(tarfile.RECORDSIZE - self.written % tarfile.RECORDSIZE))
+        self.out.write(self.buffer)
+        self.buffer = bytearray()
+        if self.compressed is not None:
+            self.compressed.close()
+
+
+def remove_sources(filedir, files):
+    # deepest first so directories are empty by the time they are removed
+    for file in sorted(files, reverse=True):
+        path = os.path.join(filedir, file)
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+            else:
+                os.remove(path)
+        except OSError as err:
+            print(f'failed to remove {path}: {err}')
+
+
+def archive_dir(filedir, tarfile_name, codec='none', level=None, files=None, remove=True):
+    # written as a dotfile, synced and renamed once sealed, sources only removed after that so a crash
+    # neither loses data nor leaves a partial archive to upload, returns the number of entries
+    if files is None:
+        entries = ((path, entry.stat(follow_symlinks=False)) for path, entry in scan_tree(filedir))
+    else:
+        entries = ((path, os.lstat(os.path.join(filedir, path))) for path in files)
+    tmp_name = os.path.join(os.path.dirname(tarfile_name), f'.{os.path.basename(tarfile_name)}')
+    added = []
+    try:
+        with open(tmp_name, 'wb') as f:
+            writer = ArchiveWriter(f, codec=codec, level=level)
+            for path, st in entries:
+                if writer.add(os.path.join(filedir, path), path, st):
+                    added.append(path)
+            writer.close()
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    if not added:
+        os.remove(tmp_name)
+        return 0
+    os.rename(tmp_name, tarfile_name)
+    if remove:
+        remove_sources(filedir, added)
+    return len(added)
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import traceback
+
+from archiver import archive_dir
+from s3_app import CODEC_RESULTS, CODECS, choose_codec, codec_cost, get_nondot_files, parse_codec
+
+
+DEFAULT_CODECS = 'gzip:1,gzip:6,gzip:9,xz:1,xz:6,xz:9,zstd:1,zstd:3,zstd:9,zstd:19'
+
+
+def benchmark_codec(filedir, files, codec, level, tmpdir):
+    # archive files with archive_dir like tar_files would, without removing them, and measure what it cost
+    tarfile = os.path.join(tmpdir, f'benchmark{CODECS[codec][1]}')
+    start = time.monotonic()
+    # archived in a child so wait4 gives the usage and peak RSS of this codec alone,
+    # including a zstd process it waited for
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            archive_dir(filedir, tarfile, codec=codec, level=level, files=files, remove=False)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    _, status, usage = os.wait4(pid, 0)
+    wall_seconds = time.monotonic() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f'archiving {filedir} with {codec}:{level} failed')
+    input_bytes = sum(os.path.getsize(os.path.join(filedir, file))
+                      for file in files if os.path.isfile(os.path.join(filedir, file)))
+    compressed_bytes = os.path.getsize(tarfile)
+    os.remove(tarfile)
+    return {
+        'codec': codec,
+        'level': level,
+        'input_bytes': input_bytes,
+        'compressed_bytes': compressed_bytes,
+        'ratio': round(input_bytes / compressed_bytes, 2) if compressed_bytes else 0,
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3),
+        'wall_seconds': round(wall_seconds, 3),
+        # kilobytes on Linux
+        'peak_rss_kb': usage.ru_maxrss,
+    }
+
+
+def run(filedir, codecs):
+    timestamp = int(time.time())
+    hostname = os.getenv("HOSTNAME", platform.node())
+    telemetry = os.path.basename(os.path.normpath(filedir))
+    files = get_nondot_files(os.path.normpath(filedir))
+    results = []
+    if not files:
+        print(f'no files found in {filedir}')
+        return results
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for codec, level in codecs:
+            try:
+                result = benchmark_codec(os.path.normpath(filedir), files, codec, level, tmpdir)
+            except (OSError, RuntimeError) as err:
+                print(f'{codec}:{level} failed on {filedir}: {err}')
+                continue
+            result.update({'timestamp': timestamp, 'hostname': hostname, 'telemetry': telemetry})
+            result['joules_per_mb'] = round(codec_cost(result) * 1024 * 1024, 3)
+            results.append(result)
+    return results
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='benchmark archive codecs on telemetry directories')
+    parser.add_argument(
+        "dirs",
+        help="sample telemetry directories, named for their telemetry type like /flash/telemetry/ais",
+        nargs="+",
+        type=str,
+    )
+    parser.add_argument(
+        "--codecs",
+        help="comma separated codec:level list to compare",
+        type=str,
+        default=DEFAULT_CODECS,
+    )
+    parser.add_argument(
+        "--results",
+        help="append the results as JSON lines to this file, ARCHIVE_CODECS entries set to auto choose from it",
+        type=str,
+        default=CODEC_RESULTS,
+    )
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    codecs = [parse_codec(spec) for spec in args.codecs.split(',')]
+    for filedir in args.dirs:
+        results = run(filedir, codecs)
+        for result in results:
+            print(json.dumps(result))
+        print(f'{filedir}: {choose_codec(results)}')
+        if args.results:
+            with open(args.results, 'a') as f:
+                for result in results:
+                    f.write(f'{json.dumps(result)}\n')
+
+
+if __name__ == '__main__':
+    main()
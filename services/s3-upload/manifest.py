@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    uploaded REAL NOT NULL,
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (sha256, key)
+);
+CREATE INDEX IF NOT EXISTS uploads_path ON uploads (path);
+'''
+COLUMNS = ('sha256', 'size', 'uploaded', 'key', 'path')
+
+
+def file_sha256(path, chunk_size=1024*1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadManifest:
+    # every object that reached the bucket, keyed by content hash, on /flash so it survives reflashes,
+    # in WAL mode so freespacer can read it while the uploader writes
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.lock = threading.Lock()
+        if readonly:
+            self.db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(SCHEMA)
+            self.db.commit()
+
+    def lookup(self, sha256, key=None):
+        # the same bytes under another name are a different object, with key only that one counts
+        query = f'SELECT {", ".join(COLUMNS)} FROM uploads WHERE sha256 = ?'
+        args = (sha256,)
+        if key is not None:
+            query += ' AND key = ?'
+            args += (key,)
+        with self.lock:
+            row = self.db.execute(query, args).fetchone()
+        if row is None:
+            return None
+        return dict(zip(COLUMNS, row))
+
+    def lookup_path(self, path):
+        with self.lock:
+            row = self.db.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM uploads WHERE path = ? ORDER BY uploaded DESC LIMIT 1',
+                (path,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(COLUMNS, row))
+
+    def is_uploaded(self, path=None, sha256=None):
+        if sha256 is not None:
+            return self.lookup(sha256) is not None
+        return self.lookup_path(path) is not None
+
+    def record(self, sha256, size, key, path, uploaded=None):
+        if uploaded is None:
+            uploaded = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO uploads (sha256, size, uploaded, key, path) VALUES (?, ?, ?, ?, ?)',
+                (sha256, size, uploaded, key, path))
+            self.db.commit()
+
+    def move(self, old_path, new_path):
+        # the local copy moved, like into /flash/s3/uploaded, keep the path pointing at it
+        with self.lock:
+            self.db.execute('UPDATE uploads SET path = ? WHERE path = ?', (new_path, old_path))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='check files against the S3 upload manifest')
+    parser.add_argument(
+        "manifest",
+        help="manifest database, like /flash/s3/.manifest.db",
+        type=str,
+    )
+    parser.add_argument(
+        "files",
+        help="files to look up by content hash",
+        nargs="+",
+        type=str,
+    )
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    manifest = UploadManifest(args.manifest, readonly=True)
+    missing = 0
+    for path in args.files:
+        entry = manifest.lookup(file_sha256(path)) if os.path.isfile(path) else manifest.lookup_path(path)
+        if entry is None:
+            missing += 1
+        print(json.dumps({'path': path, 'uploaded': entry}))
+    manifest.close()
+    sys.exit(1 if missing else 0)
+
+
+if __name__ == '__main__':
+    main()
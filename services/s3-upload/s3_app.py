@@ -1,30 +1,80 @@
 #!/usr/bin/python3
 
+import json
 import os
 import platform
 import shutil
 import subprocess
 import time
-from pathlib import Path
 
 import schedule
 
+from archiver import archive_dir, scan_tree
+from manifest import UploadManifest
+from upload_window import UploadWindow, probe_hosts
+from uploader import S3Uploader, UploadPool, parse_priorities
+
 
 S3_BUCKET = os.getenv("S3_BUCKET", "")
 FLASH_DIR = '/flash'
 TELEMETRY_DIR = os.path.join(FLASH_DIR, 'telemetry')
 S3_DIR = os.path.join(FLASH_DIR, 's3')
+# with UPLOAD_KEEP_LOCAL uploaded files are moved here instead of removed, freespacer evicts
+# them first so the disk holds as much shipped data as it has room for
+UPLOADED_DIR = os.path.join(S3_DIR, 'uploaded')
+UPLOAD_KEEP_LOCAL = os.getenv("UPLOAD_KEEP_LOCAL", "false").lower() in ('1', 'true', 'yes')
+# freespacer creates this when the disk is forecast to fill, the bulk job then runs in the next window
+UPLOAD_REQUEST_FILE = os.path.join(S3_DIR, '.upload-now')
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "3"))
+# extra workers that only take priority class 0 (status) files
+UPLOAD_URGENT_WORKERS = int(os.getenv("UPLOAD_URGENT_WORKERS", "1"))
+# per type priority class and deadline, like "status=0:3600,hydrophone=3:604800"
+UPLOAD_PRIORITIES = os.getenv("UPLOAD_PRIORITIES", "")
+# upload windows open when a probe to these host:port gets through (default the S3 endpoint)
+# and the pijuice battery charge is at least UPLOAD_MIN_CHARGE percent
+UPLOAD_PROBE_HOSTS = os.getenv("UPLOAD_PROBE_HOSTS", "")
+UPLOAD_MIN_CHARGE = float(os.getenv("UPLOAD_MIN_CHARGE", "40"))
+# seconds between opportunistic runs, and after which a job runs whatever the link or battery
+STATUS_MIN_INTERVAL = int(os.getenv("STATUS_MIN_INTERVAL", str(3600)))
+STATUS_DEADLINE = int(os.getenv("STATUS_DEADLINE", str(3 * 3600)))
+BULK_MIN_INTERVAL = int(os.getenv("BULK_MIN_INTERVAL", str(20 * 3600)))
+BULK_DEADLINE = int(os.getenv("BULK_DEADLINE", str(48 * 3600)))
+# seal closed telemetry files into segments of at most SEGMENT_MAX_MB through the day, once the
+# oldest has waited SEGMENT_SECONDS, instead of leaving them all to the daily job (0 disables)
+SEGMENT_SECONDS = int(os.getenv("SEGMENT_SECONDS", str(3600)))
+SEGMENT_MAX_MB = int(os.getenv("SEGMENT_MAX_MB", "16"))
+# writers rename the dotfile over the same file for a while, only files this old are closed
+SEGMENT_SETTLE_SECONDS = int(os.getenv("SEGMENT_SETTLE_SECONDS", "900"))
+# archive telemetry straight into S3 instead of staging tar files in /flash/s3
+UPLOAD_STREAM = os.getenv("UPLOAD_STREAM", "false").lower() in ('1', 'true', 'yes')
+# codec: (compressor command, archive suffix, default level)
+CODECS = {
+    'none': (None, '.tar', None),
+    'gzip': ('gzip', '.tar.gz', 6),
+    'xz': ('xz', '.tar.xz', 6),
+    'zstd': ('zstd', '.tar.zst', 3),
+}
+# default codec per telemetry type, ARCHIVE_CODECS overrides them like "ais=zstd:19,gps=auto"
 TELEMETRY_TYPES = [
-    ('system', True), ('sensors', True), ('power', True), ('ais', True), ('gps', True), ('hydrophone', False)]
+    ('system', 'xz'), ('sensors', 'xz'), ('power', 'xz'), ('ais', 'xz'), ('gps', 'xz'), ('hydrophone', 'none')]
+ARCHIVE_CODECS = os.getenv("ARCHIVE_CODECS", "")
+# "auto" picks the cheapest codec from the last codec_benchmark.py run for that type
+CODEC_RESULTS = os.path.join(S3_DIR, '.codec-benchmark.json')
+# energy of a CPU second compressing and of a byte sent over the cellular modem
+CODEC_JOULES_PER_CPU_SECOND = float(os.getenv("CODEC_JOULES_PER_CPU_SECOND", "1.5"))
+CODEC_JOULES_PER_BYTE = float(os.getenv("CODEC_JOULES_PER_BYTE", "0.00001"))
+CODEC_MAX_RSS_KB = int(os.getenv("CODEC_MAX_RSS_KB", str(128 * 1024)))
 
 
 def run_cmd(args, env=None):
-    if env is None:
-        env = os.environ.copy()
+    cmd_env = os.environ.copy()
+    if env is not None:
+        cmd_env.update(env)
     print(f'running {args}')
     ret = -1
     try:
-        ret = subprocess.check_call(args)
+        ret = subprocess.check_call(args, env=cmd_env)
         print('%s returned %d' % (' '.join(args), ret))
     except subprocess.CalledProcessError as err:
         print('%s returned %s' % (' '.join(args), err))
@@ -32,33 +82,210 @@ def run_cmd(args, env=None):
 
 
 def get_nondot_files(filedir):
-    return [str(path).replace(filedir, '')[1:] for path in Path(filedir).rglob('*')
-            if not os.path.basename(path).startswith('.')]
+    # like the rglob it replaced, a directory that isn't there yet has no files
+    if not os.path.isdir(filedir):
+        return []
+    return [path for path, _ in scan_tree(filedir)]
+
+
+def parse_codec(spec):
+    # "xz:9" -> ('xz', 9), "zstd" -> ('zstd', 3)
+    codec, _, level = spec.strip().partition(':')
+    if codec not in CODECS:
+        raise ValueError(f'unknown codec {spec}')
+    return codec, int(level) if level else CODECS[codec][2]
+
+
+def archive_codecs(config=ARCHIVE_CODECS):
+    codecs = dict(TELEMETRY_TYPES)
+    for entry in config.split(','):
+        if entry.strip():
+            telemetry, _, spec = entry.partition('=')
+            codecs[telemetry.strip()] = spec.strip()
+    return codecs
+
+
+def codec_cost(result, joules_per_cpu_second=CODEC_JOULES_PER_CPU_SECOND, joules_per_byte=CODEC_JOULES_PER_BYTE):
+    # per input byte, so runs on different sample sizes compare
+    cost = result['cpu_seconds'] * joules_per_cpu_second + result['compressed_bytes'] * joules_per_byte
+    return cost / max(result['input_bytes'], 1)
+
+
+def choose_codec(results, max_rss_kb=CODEC_MAX_RSS_KB, **cost_args):
+    candidates = [result for result in results if result['peak_rss_kb'] <= max_rss_kb]
+    if not candidates:
+        return None
+    best = min(candidates, key=lambda result: codec_cost(result, **cost_args))
+    if best['level'] is None:
+        return best['codec']
+    return f'{best["codec"]}:{best["level"]}'
+
 
+def load_codec_results(telemetry, path=CODEC_RESULTS):
+    # the codec_benchmark.py results for telemetry from its most recent run
+    results = []
+    try:
+        with open(path) as f:
+            for line in f:
+                result = json.loads(line)
+                if result.get('telemetry') != telemetry:
+                    continue
+                if results and result['timestamp'] != results[-1]['timestamp']:
+                    results = []
+                results.append(result)
+    except (FileNotFoundError, ValueError) as err:
+        print(f'no codec benchmark results for {telemetry}: {err}')
+    return results
+
+
+def telemetry_codec(telemetry, spec):
+    if spec == 'auto':
+        chosen = choose_codec(load_codec_results(telemetry))
+        print(f'codec for {telemetry} chosen from benchmark: {chosen}')
+        spec = chosen or dict(TELEMETRY_TYPES).get(telemetry, 'xz')
+    return parse_codec(spec)
+
+
+def keep_uploaded(manifest=None, uploaded_dir=UPLOADED_DIR):
+    # on_success for the pool that moves an uploaded file into uploaded_dir instead of removing it
+    def keep(path):
+        os.makedirs(uploaded_dir, exist_ok=True)
+        kept = os.path.join(uploaded_dir, os.path.basename(path))
+        os.rename(path, kept)
+        if manifest is not None:
+            manifest.move(path, kept)
+    return keep
 
-def s3_copy(filedir, aws='/usr/local/bin/aws'):
-    for path in Path(filedir).rglob('*'):
-        if os.path.isfile(path):
-            s3_args = [aws, 's3', 'cp', str(path), S3_BUCKET]
-            if run_cmd(s3_args):
-                os.remove(path)
 
+def upload_requested(request_file=UPLOAD_REQUEST_FILE):
+    try:
+        os.remove(request_file)
+    except FileNotFoundError:
+        return False
+    print(f'early upload requested through {request_file}')
+    return True
+
+
+def s3_copy(filedir, aws='/usr/local/bin/aws', pool=None, wait=True, on_success=os.remove, uploaded_dir=UPLOADED_DIR):
+    # dot entries are in progress, like the upload journals, and uploaded_dir has already gone
+    paths = [os.path.join(filedir, path) for path, entry in scan_tree(filedir) if entry.is_file(follow_symlinks=False)]
+    paths = [path for path in paths if not path.startswith(uploaded_dir + os.sep)]
+    if pool is not None:
+        batch = pool.submit(paths, on_success=on_success)
+        if wait:
+            return batch.wait()
+        return batch
+    for path in paths:
+        if run_cmd([aws, 's3', 'cp', path, S3_BUCKET]):
+            on_success(path)
+    return None
 
-def tar_dir(filedir, tarfile, xz=False):
+
+def tar_dir(filedir, tarfile, xz=False, codec=None, level=None):
+    if codec is None:
+        codec = 'xz' if xz else 'none'
+    if level is None:
+        level = CODECS[codec][2]
+    start = time.monotonic()
+    try:
+        entries = archive_dir(filedir, tarfile, codec=codec, level=level)
+    except OSError as err:
+        print(f'archiving {filedir} into {tarfile} failed: {err}')
+        return False
+    if entries:
+        print(f'archived {entries} entries from {filedir} into {tarfile} in {time.monotonic() - start:.2f}s')
+        return True
+    print(f'no files found in {filedir}')
+    return False
+
+
+def tar_files(filedir, files, tarfile, codec='none', level=None):
+    try:
+        return archive_dir(filedir, tarfile, codec=codec, level=level, files=files) > 0
+    except OSError as err:
+        print(f'archiving {filedir} into {tarfile} failed: {err}')
+        return False
+
+
+class Segmenter:
+    # a type is sealed once its closed files, not dotfiles and unchanged for settle_seconds, add up to
+    # max_bytes or the oldest has waited max_seconds, what's left goes with the daily job
+
+    def __init__(self, telemetry_dir, s3_dir, hostname, submit, max_bytes=16*1024*1024, max_seconds=3600,
+                 settle_seconds=900, busy=None, time_sec=time.time):
+        self.telemetry_dir = telemetry_dir
+        self.s3_dir = s3_dir
+        self.hostname = hostname
+        self.submit = submit
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.settle_seconds = settle_seconds
+        # dirs being streamed by the daily job are left alone
+        self.busy = busy or (lambda filedir: False)
+        self.time_sec = time_sec
+        self.sequence = 0
+
+    def closed_files(self, filedir, now):
+        files = []
+        for path, entry in scan_tree(filedir):
+            if entry.is_file(follow_symlinks=False):
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    # evicted or compacted by freespacer since it was listed
+                    continue
+                if stat.st_mtime <= now - self.settle_seconds:
+                    files.append((path, stat.st_size, stat.st_mtime))
+        return sorted(files, key=lambda f: (f[2], f[0]))
+
+    def seal(self, telemetry, filedir, files):
+        codec, level = telemetry_codec(telemetry, archive_codecs()[telemetry])
+        self.sequence += 1
+        name = f'{telemetry}-{self.hostname}-{int(self.time_sec())}-{self.sequence}{CODECS[codec][1]}'
+        tarfile = os.path.join(self.s3_dir, name)
+        size = sum(f[1] for f in files)
+        print(f'sealing {len(files)} files ({size} bytes) from {filedir} into {tarfile}')
+        if not tar_files(filedir, [f[0] for f in files], tarfile, codec=codec, level=level):
+            return None
+        self.submit(tarfile)
+        return tarfile
+
+    def tick(self):
+        now = self.time_sec()
+        sealed = []
+        for telemetry in archive_codecs():
+            filedir = os.path.join(self.telemetry_dir, telemetry)
+            if not os.path.isdir(filedir) or self.busy(filedir):
+                continue
+            files = self.closed_files(filedir, now)
+            while files:
+                total = sum(f[1] for f in files)
+                if total < self.max_bytes and files[0][2] > now - self.max_seconds:
+                    break
+                segment = []
+                segment_bytes = 0
+                for f in files:
+                    if segment and segment_bytes + f[1] > self.max_bytes:
+                        break
+                    segment.append(f)
+                    segment_bytes += f[1]
+                files = files[len(segment):]
+                tarfile = self.seal(telemetry, filedir, segment)
+                if tarfile is None:
+                    break
+                sealed.append(tarfile)
+        return sealed
+
+
+def stream_dir(filedir, name, uploader, codec='none', level=None):
     nondot_files = get_nondot_files(filedir)
     if nondot_files:
-        tar_args = ['/usr/bin/tar', '--remove-files', '--sort=name', '-C', filedir]
-        if xz:
-            tar_args.append('-J')
-        tar_args.extend(['-cf', tarfile])
-        tar_args.extend(nondot_files)
-        run_cmd(tar_args, env={'XZ_OPT': '-9'})
-        return True
+        return uploader.stream_archive(filedir, nondot_files, name, codec=codec, level=level)
     print(f'no files found in {filedir}')
     return False
 
 
-def job(hostname, status):
+def job(hostname, status, pool=None, stream=UPLOAD_STREAM, on_success=os.remove):
     timestamp = int(time.time())
     if not os.path.exists(S3_DIR):
         os.mkdir(S3_DIR)
@@ -70,26 +297,75 @@ def job(hostname, status):
             shutil.copy(full_file, os.path.join(S3_DIR, file))
             os.remove(full_file)
     else:
-        for telemetry, xz in TELEMETRY_TYPES:
+        streams = []
+        for telemetry, spec in archive_codecs().items():
             filedir = os.path.join(TELEMETRY_DIR, telemetry)
             if not os.path.exists(filedir):
                 os.mkdir(filedir)
-            tarfile = f'{S3_DIR}/{telemetry}-{hostname}-{timestamp}.tar'
-            if xz:
-                tarfile = tarfile + '.xz'
+            codec, level = telemetry_codec(telemetry, spec)
+            tarfile = f'{S3_DIR}/{telemetry}-{hostname}-{timestamp}{CODECS[codec][1]}'
+            if stream and pool is not None:
+                entries = list(scan_tree(filedir))
+                if not entries:
+                    print(f'no files found in {filedir}')
+                    continue
+                print(f'processing {filedir}, streaming {os.path.basename(tarfile)}')
+                size = sum(entry.stat(follow_symlinks=False).st_size for _, entry in entries if entry.is_file(follow_symlinks=False))
+                # queued under filedir so the next job doesn't stream the same files while this one runs
+                streams.append((filedir, size, lambda filedir=filedir, name=os.path.basename(tarfile), codec=codec, level=level:
+                                stream_dir(filedir, name, pool.uploader, codec=codec, level=level)))
+                continue
             print(f'processing {filedir}, tar {tarfile}')
-            tar_dir(filedir, tarfile, xz=xz)
-    s3_copy(S3_DIR)
+            tar_dir(filedir, tarfile, codec=codec, level=level)
+        if streams:
+            pool.submit([], tasks=streams)
+    # the pool uploads in the background by priority, so this hour's status doesn't wait
+    # for yesterday's hydrophone archives
+    s3_copy(S3_DIR, pool=pool, wait=pool is None, on_success=on_success)
     return
 
 
 def main():
     hostname = os.getenv("HOSTNAME", platform.node())
+    if not os.path.exists(S3_DIR):
+        os.mkdir(S3_DIR)
+    manifest = UploadManifest(os.path.join(S3_DIR, '.manifest.db'))
+    uploader = S3Uploader(S3_BUCKET, journal_dir=os.path.join(S3_DIR, '.uploads'), manifest=manifest)
+    pool = UploadPool(uploader, workers=UPLOAD_WORKERS, retries=UPLOAD_RETRIES,
+                      priorities=parse_priorities(UPLOAD_PRIORITIES), urgent_workers=UPLOAD_URGENT_WORKERS)
+    uploaded = keep_uploaded(manifest) if UPLOAD_KEEP_LOCAL else os.remove
+    window = UploadWindow(
+        os.path.join(TELEMETRY_DIR, 'power'), probe_hosts(uploader.endpoint_url, UPLOAD_PROBE_HOSTS),
+        min_charge=UPLOAD_MIN_CHARGE)
+
+    def submit_segment(tarfile):
+        # a shut window leaves the segment in S3_DIR for the next job's s3_copy
+        if window.open():
+            pool.submit([tarfile], on_success=uploaded)
+        else:
+            print(f'upload window shut, {tarfile} waits for the next job')
+
+    segmenter = None
+    if SEGMENT_SECONDS:
+        segmenter = Segmenter(
+            TELEMETRY_DIR, S3_DIR, hostname, submit_segment,
+            max_bytes=SEGMENT_MAX_MB * 1024 * 1024, max_seconds=SEGMENT_SECONDS,
+            settle_seconds=SEGMENT_SETTLE_SECONDS, busy=lambda filedir: filedir in pool.active)
+    window.add_job('bulk', lambda: job(hostname, status=False, pool=pool, on_success=uploaded),
+                   BULK_MIN_INTERVAL, BULK_DEADLINE)
+    window.add_job('status', lambda: job(hostname, status=True, pool=pool, on_success=uploaded),
+                   STATUS_MIN_INTERVAL, STATUS_DEADLINE)
+    # the fixed times are now fallbacks, they mark the job due and it runs in the next window
     # time is in UTC because it's a container
-    schedule.every().day.at("18:00").do(job, hostname=hostname, status=False)
-    schedule.every().hour.do(job, hostname=hostname, status=True)
+    schedule.every().day.at("18:00").do(window.due, 'bulk')
+    schedule.every().hour.do(window.due, 'status')
     while True:
         schedule.run_pending()
+        if upload_requested():
+            window.due('bulk')
+        window.tick()
+        if segmenter is not None:
+            segmenter.tick()
         sleep_time = 60
         time.sleep(sleep_time)
 
@@ -1,10 +1,124 @@
 #!/usr/bin/python3
 
+import hashlib
+import io
+import json
 import os
 import subprocess
+import tarfile
 import tempfile
+import threading
 import unittest
-from s3_app import tar_dir, s3_copy
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from archiver import archive_dir
+from codec_benchmark import run as benchmark_codecs
+import s3_app
+from manifest import UploadManifest, file_sha256
+from s3_app import (tar_dir, s3_copy, stream_dir, Segmenter, choose_codec, archive_codecs, get_nondot_files, keep_uploaded,
+                    load_codec_results, upload_requested)
+import time
+from upload_window import UploadWindow, latest_battery_charge
+from uploader import S3Uploader, TokenBucket, UploadPool
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        return
+
+    def reply(self, code=200, body=b'', headers=None):
+        self.send_response(code)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse(self):
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.s3.requests.append((self.command, key, query))
+        return bucket, key, query, body
+
+    def failing(self):
+        if self.server.s3.fail_requests > 0:
+            self.server.s3.fail_requests -= 1
+            self.reply(500, b'<Error><Code>InternalError</Code></Error>')
+            return True
+        return False
+
+    def do_HEAD(self):
+        self.parse()
+        self.reply()
+
+    def do_PUT(self):
+        bucket, key, query, body = self.parse()
+        if self.failing():
+            return
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if 'uploadId' in query:
+            if int(query['partNumber']) in self.server.s3.fail_parts:
+                self.reply(500, b'<Error><Code>InternalError</Code></Error>')
+                return
+            self.server.s3.parts[query['uploadId']][int(query['partNumber'])] = body
+        else:
+            self.server.s3.objects[key] = body
+        self.reply(headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query, body = self.parse()
+        if self.failing():
+            return
+        if 'uploads' in query:
+            upload_id = f'upload-{len(self.server.s3.parts)}'
+            self.server.s3.parts[upload_id] = {}
+            self.reply(body=(
+                '<InitiateMultipartUploadResult>'
+                f'<Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId>'
+                '</InitiateMultipartUploadResult>').encode())
+        else:
+            parts = self.server.s3.parts.pop(query['uploadId'])
+            self.server.s3.objects[key] = b''.join(parts[n] for n in sorted(parts))
+            self.reply(body=(
+                '<CompleteMultipartUploadResult>'
+                f'<Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>"done"</ETag>'
+                '</CompleteMultipartUploadResult>').encode())
+
+    def do_DELETE(self):
+        bucket, key, query, body = self.parse()
+        self.server.s3.parts.pop(query.get('uploadId'), None)
+        self.reply(204)
+
+
+class FakeS3:
+    # just enough of the S3 API on localhost for the uploader to talk to
+
+    def __init__(self):
+        self.objects = {}
+        self.parts = {}
+        self.requests = []
+        self.fail_requests = 0
+        self.fail_parts = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+        self.server.s3 = self
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        os.environ.update({
+            'AWS_ACCESS_KEY_ID': 'test', 'AWS_SECRET_ACCESS_KEY': 'test', 'AWS_DEFAULT_REGION': 'us-east-1'})
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class apptest(unittest.TestCase):
@@ -22,6 +136,362 @@ class apptest(unittest.TestCase):
             s3_copy(test_dir, aws='/bin/true')
             self.assertFalse(os.path.exists(tar_file))
 
+    def test_s3_copy_uploader(self):
+        with tempfile.TemporaryDirectory() as tmpdir, FakeS3() as s3:
+            for name in ('a.tar.xz', 'b.json'):
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(name)
+            uploader = S3Uploader('s3://bucket/prefix', endpoint_url=s3.url, max_attempts=1)
+            pool = UploadPool(uploader, retries=1, backoff_seconds=0)
+            s3_copy(tmpdir, pool=pool)
+            self.assertEqual({'prefix/a.tar.xz': b'a.tar.xz', 'prefix/b.json': b'b.json'}, s3.objects)
+            self.assertEqual([], os.listdir(tmpdir))
+            # failed uploads leave the file for the next pass
+            with open(os.path.join(tmpdir, 'c.json'), 'w') as f:
+                f.write('c')
+            s3.fail_requests = 2
+            s3_copy(tmpdir, pool=pool)
+            self.assertEqual(['c.json'], os.listdir(tmpdir))
+
+    def test_multipart_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir, FakeS3() as s3:
+            test_file = os.path.join(tmpdir, 'hydrophone.tar')
+            data = os.urandom(2500)
+            with open(test_file, 'wb') as f:
+                f.write(data)
+            journal_dir = os.path.join(tmpdir, '.uploads')
+            uploader = S3Uploader('s3://bucket/', endpoint_url=s3.url, max_attempts=1,
+                                  journal_dir=journal_dir, multipart_threshold=1000, part_size=1000)
+            # link drops on the second part
+            s3.fail_parts = {2}
+            self.assertFalse(uploader.upload(test_file))
+            self.assertEqual(['hydrophone.tar.json'], os.listdir(journal_dir))
+            s3.fail_parts = set()
+            s3.requests = []
+            # s3_copy skips the journal directory
+            s3_copy(tmpdir, pool=UploadPool(uploader))
+            sent_parts = [int(query['partNumber']) for method, _, query in s3.requests if method == 'PUT']
+            self.assertEqual([2, 3], sent_parts)
+            self.assertEqual(data, s3.objects['hydrophone.tar'])
+            self.assertEqual([], os.listdir(journal_dir))
+            self.assertFalse(os.path.exists(test_file))
+
+    def test_upload_pool(self):
+        with tempfile.TemporaryDirectory() as tmpdir, FakeS3() as s3:
+            paths = []
+            for i in range(4):
+                paths.append(os.path.join(tmpdir, f'{i}.json'))
+                with open(paths[-1], 'wb') as f:
+                    f.write(os.urandom(16 * 1024))
+            # 64 KiB at 32 KiB/s with a 16 KiB burst takes at least 1.5 seconds
+            uploader = S3Uploader('s3://bucket/', endpoint_url=s3.url, max_attempts=1,
+                                  throttle=TokenBucket(32 * 1024, burst=16 * 1024))
+            s3.fail_requests = 1
+            start = time.monotonic()
+            # a file gone since it was listed is skipped
+            missing = os.path.join(tmpdir, 'gone.json')
+            stats = UploadPool(uploader, workers=2, retries=1, backoff_seconds=0).run(paths + [missing], on_success=os.remove)
+            self.assertGreaterEqual(time.monotonic() - start, 1.5)
+            self.assertEqual(4, stats['files'])
+            self.assertEqual(0, stats['failed'])
+            self.assertEqual(4, stats['max_queue_depth'])
+            self.assertEqual(64 * 1024, stats['bytes'])
+            self.assertEqual(4, len(s3.objects))
+            self.assertEqual([], os.listdir(tmpdir))
+
+    def test_stream_dir(self):
+        with tempfile.TemporaryDirectory() as tmpdir, tempfile.TemporaryDirectory() as manifest_dir, FakeS3() as s3:
+            contents = {}
+            for name in ('a.json', 'b.json', 'sub/c.json'):
+                os.makedirs(os.path.dirname(os.path.join(tmpdir, name)), exist_ok=True)
+                contents[name] = os.urandom(1500)
+                with open(os.path.join(tmpdir, name), 'wb') as f:
+                    f.write(contents[name])
+            manifest = UploadManifest(os.path.join(manifest_dir, '.manifest.db'))
+            uploader = S3Uploader('s3://bucket/', endpoint_url=s3.url, max_attempts=1, part_size=1000, manifest=manifest)
+            # a dropped link aborts the upload and keeps the sources
+            s3.fail_parts = {3}
+            self.assertFalse(stream_dir(tmpdir, 'ais.tar.xz', uploader, codec='xz', level=6))
+            self.assertEqual({}, s3.parts)
+            self.assertEqual(['a.json', 'b.json', 'sub'], sorted(os.listdir(tmpdir)))
+            s3.fail_parts = set()
+            self.assertTrue(stream_dir(tmpdir, 'ais.tar.xz', uploader, codec='xz', level=6))
+            self.assertEqual([], os.listdir(tmpdir))
+            with tarfile.open(fileobj=io.BytesIO(s3.objects['ais.tar.xz']), mode='r:xz') as tar:
+                self.assertEqual(['a.json', 'b.json', 'sub', 'sub/c.json'], tar.getnames())
+                for name, data in contents.items():
+                    self.assertEqual(data, tar.extractfile(name).read())
+            # recorded by hash and key, there's no local copy for the path
+            entry = manifest.lookup(hashlib.sha256(s3.objects['ais.tar.xz']).hexdigest(), key='ais.tar.xz')
+            self.assertEqual('', entry['path'])
+            self.assertFalse(manifest.is_uploaded(path=tmpdir))
+            manifest.close()
+
+    def test_get_nondot_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # like status before anything has written to it
+            self.assertEqual([], get_nondot_files(os.path.join(tmpdir, 'status')))
+            for name in ('a.json', '.b.json'):
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(name)
+            self.assertEqual(['a.json'], get_nondot_files(tmpdir))
+
+    def test_codec_policy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ais_dir = os.path.join(tmpdir, 'ais')
+            os.mkdir(ais_dir)
+            with open(os.path.join(ais_dir, 'ais.json'), 'w') as f:
+                for i in range(1000):
+                    f.write(f'{{"mmsi": {i % 10}, "timestamp": {1700000000 + i}}}\n')
+            results = benchmark_codecs(ais_dir, [('none', None), ('gzip', 1), ('xz', 6)])
+            self.assertEqual(['none', 'gzip', 'xz'], [result['codec'] for result in results])
+            self.assertEqual(['ais.json'], os.listdir(ais_dir))
+            for result in results:
+                self.assertEqual('ais', result['telemetry'])
+                self.assertGreater(result['peak_rss_kb'], 0)
+            self.assertGreater(results[0]['compressed_bytes'], results[1]['compressed_bytes'])
+            results_file = os.path.join(tmpdir, 'results.json')
+            with open(results_file, 'w') as f:
+                for result in results:
+                    f.write(f'{json.dumps(result)}\n')
+            self.assertEqual(results, load_codec_results('ais', path=results_file))
+        fake = [
+            {'codec': 'none', 'level': None, 'input_bytes': 100, 'compressed_bytes': 100, 'cpu_seconds': 0, 'peak_rss_kb': 1},
+            {'codec': 'zstd', 'level': 3, 'input_bytes': 100, 'compressed_bytes': 20, 'cpu_seconds': 1, 'peak_rss_kb': 10},
+            {'codec': 'xz', 'level': 9, 'input_bytes': 100, 'compressed_bytes': 10, 'cpu_seconds': 2, 'peak_rss_kb': 1000},
+        ]
+        # free CPU favours the smallest archive, unless it needs too much memory
+        self.assertEqual('xz:9', choose_codec(fake, joules_per_cpu_second=0, joules_per_byte=1))
+        self.assertEqual('zstd:3', choose_codec(fake, max_rss_kb=100, joules_per_cpu_second=0, joules_per_byte=1))
+        # free bytes favours not compressing
+        self.assertEqual('none', choose_codec(fake, joules_per_cpu_second=1, joules_per_byte=0))
+        codecs = archive_codecs('ais=zstd:19, gps=auto')
+        self.assertEqual(('zstd:19', 'auto', 'none'), (codecs['ais'], codecs['gps'], codecs['hydrophone']))
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdir, FakeS3() as s3:
+            manifest = UploadManifest(os.path.join(tmpdir, '.manifest.db'))
+            uploader = S3Uploader('s3://bucket/', endpoint_url=s3.url, max_attempts=1, manifest=manifest)
+            pool = UploadPool(uploader, retries=0)
+            test_file = os.path.join(tmpdir, 'power.json')
+            with open(test_file, 'w') as f:
+                f.write('power')
+            sha256 = file_sha256(test_file)
+            self.assertFalse(manifest.is_uploaded(sha256=sha256))
+            s3_copy(tmpdir, pool=pool)
+            self.assertFalse(os.path.exists(test_file))
+            entry = manifest.lookup(sha256)
+            self.assertEqual((5, 'power.json', test_file), (entry['size'], entry['key'], entry['path']))
+            # the same data again, like after a failed remove or a reflash, isn't uploaded twice
+            with open(test_file, 'w') as f:
+                f.write('power')
+            s3.requests = []
+            s3_copy(tmpdir, pool=pool)
+            self.assertEqual([], [request for request in s3.requests if request[0] == 'PUT'])
+            self.assertFalse(os.path.exists(test_file))
+            # the same data under another name is its own object
+            other_file = os.path.join(tmpdir, 'power-copy.json')
+            with open(other_file, 'w') as f:
+                f.write('power')
+            s3_copy(tmpdir, pool=pool)
+            self.assertEqual(1, len([request for request in s3.requests if request[0] == 'PUT']))
+            self.assertEqual('power-copy.json', manifest.lookup(sha256, key='power-copy.json')['key'])
+            self.assertEqual('power.json', manifest.lookup(sha256, key='power.json')['key'])
+            # other services read it without taking a write lock
+            reader = UploadManifest(os.path.join(tmpdir, '.manifest.db'), readonly=True)
+            self.assertTrue(reader.is_uploaded(path=test_file))
+            self.assertFalse(reader.is_uploaded(sha256='0' * 64))
+            reader.close()
+            manifest.close()
+
+    def test_keep_uploaded(self):
+        with tempfile.TemporaryDirectory() as tmpdir, FakeS3() as s3:
+            manifest = UploadManifest(os.path.join(tmpdir, '.manifest.db'))
+            uploader = S3Uploader('s3://bucket/', endpoint_url=s3.url, max_attempts=1, manifest=manifest)
+            pool = UploadPool(uploader, retries=0)
+            uploaded_dir = os.path.join(tmpdir, 'uploaded')
+            test_file = os.path.join(tmpdir, 'ais.tar.xz')
+            with open(test_file, 'w') as f:
+                f.write('ais')
+            s3_copy(tmpdir, pool=pool, on_success=keep_uploaded(manifest, uploaded_dir), uploaded_dir=uploaded_dir)
+            kept = os.path.join(uploaded_dir, 'ais.tar.xz')
+            self.assertTrue(os.path.exists(kept))
+            self.assertTrue(manifest.is_uploaded(path=kept))
+            self.assertFalse(manifest.is_uploaded(path=test_file))
+            # the kept copies aren't uploaded again
+            s3.requests = []
+            s3_copy(tmpdir, pool=pool, on_success=keep_uploaded(manifest, uploaded_dir), uploaded_dir=uploaded_dir)
+            self.assertEqual([], s3.requests)
+            manifest.close()
+
+    def test_upload_priority(self):
+        with tempfile.TemporaryDirectory() as tmpdir, FakeS3() as s3:
+            names = ['hydrophone-host-1.tar', 'system-host-1.tar.xz', 'hydrophone-host-2.tar',
+                     'status-host-1.json', 'power-host-1.tar.xz']
+            for name in names:
+                with open(os.path.join(tmpdir, name), 'wb') as f:
+                    f.write(os.urandom(1000))
+            # eight days old, past the hydrophone deadline
+            old = time.time() - 8 * 86400
+            os.utime(os.path.join(tmpdir, 'hydrophone-host-2.tar'), (old, old))
+            uploader = S3Uploader('s3://bucket/', endpoint_url=s3.url, max_attempts=1)
+            pool = UploadPool(uploader, workers=1, urgent_workers=0, retries=0)
+            stats = pool.run([os.path.join(tmpdir, name) for name in names])
+            self.assertEqual(5, stats['files'])
+            self.assertEqual(1, stats['late'])
+            self.assertEqual(
+                ['status-host-1.json', 'hydrophone-host-2.tar', 'power-host-1.tar.xz',
+                 'system-host-1.tar.xz', 'hydrophone-host-1.tar'],
+                [key for method, key, _ in s3.requests if method == 'PUT'])
+
+    def test_upload_preempt(self):
+        with tempfile.TemporaryDirectory() as tmpdir, FakeS3() as s3:
+            bulk = []
+            for i in range(3):
+                bulk.append(os.path.join(tmpdir, f'hydrophone-host-{i}.tar'))
+                with open(bulk[-1], 'wb') as f:
+                    f.write(os.urandom(16 * 1024))
+            status_file = os.path.join(tmpdir, 'status-host-1.json')
+            with open(status_file, 'w') as f:
+                f.write('{}')
+            # 48 KiB of hydrophone data takes two seconds at 16 KiB/s
+            uploader = S3Uploader('s3://bucket/', endpoint_url=s3.url, max_attempts=1,
+                                  throttle=TokenBucket(16 * 1024, burst=16 * 1024))
+            pool = UploadPool(uploader, workers=1, urgent_workers=1, retries=0)
+            bulk_batch = pool.submit(bulk)
+            status_stats = pool.submit([status_file]).wait(timeout=1)
+            self.assertEqual(1, status_stats['files'])
+            self.assertFalse(bulk_batch.done.is_set())
+            self.assertEqual(3, bulk_batch.wait(timeout=10)['files'])
+
+    def test_upload_window(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertIsNone(latest_battery_charge(tmpdir))
+
+            def write_charge(charge):
+                with open(os.path.join(tmpdir, '.host-1-power.json'), 'w') as f:
+                    f.write(json.dumps({'target': 'battery_charge', 'datapoints': [[90, 0], [charge, 1]]}) + '\n')
+
+            write_charge(30)
+            with open(os.path.join(tmpdir, 'host-0-power.json'), 'w') as f:
+                f.write(json.dumps({'target': 'battery_charge', 'datapoints': [[100, 0]]}) + '\n')
+            self.assertEqual([30, 1], latest_battery_charge(tmpdir))
+            now = [0]
+            link = [True]
+            runs = []
+            window = UploadWindow(tmpdir, [], min_charge=40, probe=lambda hosts: (link[0], 10.0), time_sec=lambda: now[0])
+            window.add_job('bulk', lambda: runs.append(now[0]), 3600, 7200)
+            # too soon, then the battery is too low even when the fixed schedule says it's due
+            self.assertEqual('interval', window.tick()[0]['reason'])
+            window.due('bulk')
+            self.assertEqual('battery', window.tick()[0]['reason'])
+            write_charge(50)
+            link[0] = False
+            self.assertEqual('link', window.tick()[0]['reason'])
+            link[0] = True
+            now[0] = 60
+            self.assertEqual('scheduled', window.tick()[0]['reason'])
+            self.assertEqual([60], runs)
+            # a window opens once the interval has passed
+            now[0] = 60 + 3600
+            self.assertEqual('window', window.tick()[0]['reason'])
+            # and after the deadline it runs without a link
+            link[0] = False
+            now[0] += 7200
+            self.assertEqual('deadline', window.tick()[0]['reason'])
+            self.assertEqual([60, 3660, 10860], runs)
+            # sealed segments only go straight out when the battery and link allow
+            self.assertFalse(window.open())
+            link[0] = True
+            self.assertTrue(window.open())
+            write_charge(30)
+            self.assertFalse(window.open())
+            # freespacer asking for an early window is taken once
+            request_file = os.path.join(tmpdir, '.upload-now')
+            self.assertFalse(upload_requested(request_file))
+            with open(request_file, 'w') as f:
+                f.write('0\n')
+            self.assertTrue(upload_requested(request_file))
+            self.assertFalse(os.path.exists(request_file))
+
+    def test_segmenter(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            telemetry_dir = os.path.join(tmpdir, 'telemetry')
+            s3_dir = os.path.join(tmpdir, 's3')
+            power_dir = os.path.join(telemetry_dir, 'power')
+            os.makedirs(power_dir)
+            os.mkdir(s3_dir)
+            now = [10000]
+            for i in range(5):
+                with open(os.path.join(power_dir, f'host-{i}-power.json'), 'wb') as f:
+                    f.write(os.urandom(400))
+                os.utime(os.path.join(power_dir, f'host-{i}-power.json'), (9000 + i, 9000 + i))
+            # still being written
+            with open(os.path.join(power_dir, '.host-5-power.json'), 'w') as f:
+                f.write('{}')
+            submitted = []
+            segmenter = Segmenter(telemetry_dir, s3_dir, 'host', submitted.append, max_bytes=1000,
+                                  max_seconds=3600, settle_seconds=600, time_sec=lambda: now[0])
+            # over the size bound, sealed in segments of at most 1000 bytes, the last file is
+            # under the bound and not old enough yet
+            sealed = segmenter.tick()
+            self.assertEqual(2, len(sealed))
+            self.assertEqual(['.host-5-power.json', 'host-4-power.json'], sorted(os.listdir(power_dir)))
+            now[0] = 9004 + 3600
+            sealed.extend(segmenter.tick())
+            self.assertEqual(sealed, submitted)
+            self.assertEqual(3, len(sealed))
+            self.assertEqual(['.host-5-power.json'], os.listdir(power_dir))
+            self.assertEqual(sorted(os.path.basename(f) for f in sealed), sorted(os.listdir(s3_dir)))
+            names = []
+            for tarfile_name in sealed:
+                self.assertTrue(os.path.basename(tarfile_name).startswith('power-host-'))
+                self.assertLessEqual(os.path.getsize(tarfile_name), 1000 + 4096)
+                with tarfile.open(tarfile_name) as tar:
+                    names.extend(tar.getnames())
+            self.assertEqual([f'host-{i}-power.json' for i in range(5)], names)
+            # a file freespacer removes between the listing and the stat is skipped
+            for i in (6, 7):
+                with open(os.path.join(power_dir, f'host-{i}-power.json'), 'wb') as f:
+                    f.write(b'{}')
+                os.utime(os.path.join(power_dir, f'host-{i}-power.json'), (9000, 9000))
+            scan_tree = s3_app.scan_tree
+
+            def racing_scan_tree(filedir):
+                for path, entry in scan_tree(filedir):
+                    if path == 'host-6-power.json':
+                        os.remove(os.path.join(filedir, path))
+                    yield path, entry
+
+            with mock.patch('s3_app.scan_tree', racing_scan_tree):
+                self.assertEqual(['host-7-power.json'], [f[0] for f in segmenter.closed_files(power_dir, now[0])])
+
+    def test_archive_dir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filedir = os.path.join(tmpdir, 'sensors')
+            long_name = 'x' * 120 + '.json'
+            contents = {'a.json': b'a' * 700, 'sub/b.json': b'', f'sub/{long_name}': b'long'}
+            os.makedirs(os.path.join(filedir, 'sub'))
+            os.makedirs(os.path.join(filedir, '.partial'))
+            for name, data in contents.items():
+                with open(os.path.join(filedir, name), 'wb') as f:
+                    f.write(data)
+            for name in ('.c.json', '.partial/d.json'):
+                with open(os.path.join(filedir, name), 'w') as f:
+                    f.write(name)
+            os.symlink('a.json', os.path.join(filedir, 'link'))
+            for codec in ('none', 'gzip', 'zstd'):
+                tarfile_name = os.path.join(tmpdir, f'sensors.tar.{codec}')
+                self.assertEqual(5, archive_dir(filedir, tarfile_name, codec=codec, level=1, remove=False))
+                names = subprocess.check_output(['/usr/bin/tar', '-a', '-tf', tarfile_name]).decode().split()
+                self.assertEqual(['a.json', 'link', 'sub/', 'sub/b.json', f'sub/{long_name}'], names)
+            with tarfile.open(os.path.join(tmpdir, 'sensors.tar.none')) as tar:
+                for name, data in contents.items():
+                    self.assertEqual(data, tar.extractfile(name).read())
+                self.assertEqual('a.json', tar.getmember('link').linkname)
+            archive_dir(filedir, os.path.join(tmpdir, 'sensors.tar'))
+            self.assertEqual(['.c.json', '.partial'], sorted(os.listdir(filedir)))
+
     def test_tar_dir(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             tar_file = os.path.join(tmpdir, 'test.tar')
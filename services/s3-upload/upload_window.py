@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+import json
+import os
+import socket
+import time
+from urllib.parse import urlparse
+
+
+def latest_battery_charge(power_dir):
+    # last battery_charge datapoint, [percent, timestamp], from the newest pijuice power file
+    try:
+        # the dotfile is the one pijuice is writing now, so it is the newest
+        files = [f for f in os.listdir(power_dir) if f.endswith('-power.json')]
+    except FileNotFoundError:
+        return None
+    files.sort(key=lambda f: (f.startswith('.'), f.lstrip('.')))
+    for filename in reversed(files):
+        try:
+            with open(os.path.join(power_dir, filename)) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record.get('target') == 'battery_charge' and record.get('datapoints'):
+                        return record['datapoints'][-1]
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def probe_hosts(endpoint_url=None, hosts=''):
+    if hosts:
+        return [host.strip() for host in hosts.split(',') if host.strip()]
+    if endpoint_url:
+        parsed = urlparse(endpoint_url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        return [f'{parsed.hostname}:{port}']
+    return ['s3.amazonaws.com:443']
+
+
+def probe_link(hosts, timeout=5):
+    # TCP connect to each host:port until one answers, returns (ok, round trip ms)
+    for host in hosts:
+        name, _, port = host.rpartition(':')
+        start = time.monotonic()
+        try:
+            with socket.create_connection((name, int(port)), timeout=timeout):
+                return True, round((time.monotonic() - start) * 1000, 1)
+        except OSError:
+            continue
+    return False, None
+
+
+class UploadWindow:
+    # a job is due after its minimum interval and runs once a probe gets through and the battery is at
+    # min_charge, past its deadline it runs whatever the link or battery, each decision logged as a JSON line
+
+    def __init__(self, power_dir, hosts, min_charge=40, probe=probe_link, time_sec=time.time):
+        self.power_dir = power_dir
+        self.hosts = hosts
+        self.min_charge = min_charge
+        self.probe = probe
+        self.time_sec = time_sec
+        self.jobs = {}
+        self.last_reason = {}
+
+    def add_job(self, name, func, min_interval, deadline):
+        self.jobs[name] = {'func': func, 'min_interval': min_interval, 'deadline': deadline,
+                           'last_run': self.time_sec(), 'due': False}
+
+    def due(self, name):
+        # called by the fixed schedule, the fallback when no window opened before it
+        self.jobs[name]['due'] = True
+
+    def open(self):
+        # battery and link right now, for uploads that don't go through a job like sealed segments
+        charge = latest_battery_charge(self.power_dir)
+        if charge is not None and charge[0] < self.min_charge:
+            return False
+        return self.probe(self.hosts)[0]
+
+    def decide(self, name):
+        job = self.jobs[name]
+        now = self.time_sec()
+        since = now - job['last_run']
+        decision = {'job': name, 'timestamp': int(now), 'since_last_run': int(since), 'due': job['due']}
+        if since >= job['deadline']:
+            decision.update({'run': True, 'reason': 'deadline'})
+            return decision
+        if not job['due'] and since < job['min_interval']:
+            decision.update({'run': False, 'reason': 'interval'})
+            return decision
+        charge = latest_battery_charge(self.power_dir)
+        decision['battery_charge'] = charge[0] if charge else None
+        if charge is not None and charge[0] < self.min_charge:
+            decision.update({'run': False, 'reason': 'battery'})
+            return decision
+        link, rtt_ms = self.probe(self.hosts)
+        decision.update({'link': link, 'rtt_ms': rtt_ms})
+        if not link:
+            decision.update({'run': False, 'reason': 'link'})
+            return decision
+        decision.update({'run': True, 'reason': 'scheduled' if job['due'] else 'window'})
+        return decision
+
+    def tick(self):
+        decisions = []
+        for name, job in self.jobs.items():
+            decision = self.decide(name)
+            # the interval wait isn't worth a line a minute, and neither is the same deferral again
+            if decision['run'] or (decision['reason'] != 'interval' and decision['reason'] != self.last_reason.get(name)):
+                print(f'upload window: {json.dumps(decision)}')
+            self.last_reason[name] = decision['reason']
+            if decision['run']:
+                job['last_run'] = self.time_sec()
+                job['due'] = False
+                job['func']()
+            decisions.append(decision)
+        return decisions
@@ -0,0 +1,501 @@
+#!/usr/bin/python3
+
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+from archiver import ArchiveWriter, remove_sources
+from manifest import file_sha256
+
+
+MB = 1024 * 1024
+
+
+def parse_s3_url(url):
+    # s3://bucket/some/prefix/ -> ('bucket', 'some/prefix/')
+    parsed = urlparse(url)
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+class TokenBucket:
+    # global bandwidth cap shared by all upload workers, leaving room for the status webhook
+
+    def __init__(self, rate, burst=None):
+        # rate in bytes per second, 0 means unlimited
+        self.rate = rate
+        self.burst = burst or max(rate, 64 * 1024)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        while amount > 0:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                take = min(amount, self.tokens)
+                self.tokens -= take
+                amount -= take
+                wait = amount / self.rate if amount else 0
+            if wait:
+                time.sleep(min(wait, 1))
+
+
+class ThrottledReader(io.RawIOBase):
+    # request body that takes tokens from the bucket as the HTTP client reads it
+
+    def __init__(self, raw, throttle):
+        super().__init__()
+        self.raw = raw
+        self.throttle = throttle
+        # botocore reads the body more than once (checksums, retries), only charge each byte once
+        self.charged = raw.tell()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        end = self.raw.tell()
+        if end > self.charged:
+            self.throttle.consume(end - self.charged)
+            self.charged = end
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.raw.seek(offset, whence)
+
+    def tell(self):
+        return self.raw.tell()
+
+
+class UploadJournal:
+    # on-flash record of a multipart upload's acknowledged parts, so it resumes after a reboot or link loss
+
+    def __init__(self, journal_dir, path):
+        self.journal_dir = journal_dir
+        self.filename = os.path.join(journal_dir, f'{os.path.basename(path)}.json')
+        self.state = None
+
+    def load(self, key, size, mtime, part_size):
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # only resume if the file is still the one the parts were read from
+        if (state.get('key'), state.get('size'), state.get('mtime'), state.get('part_size')) != (key, size, mtime, part_size):
+            self.remove()
+            return None
+        self.state = state
+        return state
+
+    def start(self, key, size, mtime, part_size, upload_id):
+        self.state = {'key': key, 'size': size, 'mtime': mtime, 'part_size': part_size,
+                      'upload_id': upload_id, 'parts': {}}
+        self.save()
+
+    def add_part(self, number, etag, md5):
+        self.state['parts'][str(number)] = {'etag': etag, 'md5': md5}
+        self.save()
+
+    def save(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        tmp_filename = f'{self.filename}.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+
+    def remove(self):
+        self.state = None
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+class MultipartWriter(io.RawIOBase):
+    # write only file that sends each part_size chunk as a multipart upload part as soon as it fills
+
+    def __init__(self, uploader, key):
+        super().__init__()
+        self.uploader = uploader
+        self.key = key
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes = 0
+        self.sha256 = hashlib.sha256()
+        self.upload_id = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.bytes += len(data)
+        self.sha256.update(data)
+        while len(self.buffer) >= self.uploader.part_size:
+            self.send_part(bytes(self.buffer[:self.uploader.part_size]))
+            del self.buffer[:self.uploader.part_size]
+        return len(data)
+
+    def send_part(self, data):
+        client = self.uploader.client
+        if self.upload_id is None:
+            response = client.create_multipart_upload(Bucket=self.uploader.bucket, Key=self.key)
+            self.upload_id = response['UploadId']
+        number = len(self.parts) + 1
+        response = client.upload_part(
+            Bucket=self.uploader.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number,
+            Body=ThrottledReader(io.BytesIO(data), self.uploader.throttle),
+            ContentMD5=base64.b64encode(hashlib.md5(data).digest()).decode('ascii'))
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def complete(self):
+        # the last part may be short, S3 only requires the others to be at least 5 MiB
+        if self.buffer or not self.parts:
+            self.send_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.uploader.client.complete_multipart_upload(
+            Bucket=self.uploader.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.upload_id is not None:
+            try:
+                self.uploader.client.abort_multipart_upload(
+                    Bucket=self.uploader.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as err:
+                print(f'abort of s3://{self.uploader.bucket}/{self.key} failed: {err}')
+
+
+class S3Uploader:
+
+    def __init__(self, bucket_url, endpoint_url=None, client=None, max_pool_connections=4, max_attempts=3,
+                 journal_dir='/flash/s3/.uploads', multipart_threshold=8*MB, part_size=8*MB, throttle=None,
+                 manifest=None):
+        self.bucket, self.prefix = parse_s3_url(bucket_url)
+        if endpoint_url is None:
+            endpoint_url = os.getenv("S3_ENDPOINT_URL", "") or None
+        self.endpoint_url = endpoint_url
+        self.max_pool_connections = max_pool_connections
+        self.max_attempts = max_attempts
+        self.journal_dir = journal_dir
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        if throttle is None:
+            throttle = TokenBucket(int(os.getenv("UPLOAD_RATE_KBPS", "0")) * 1024)
+        self.throttle = throttle
+        # UploadManifest of everything already in the bucket, if any
+        self.manifest = manifest
+        self._client = client
+
+    @property
+    def client(self):
+        # one client for the life of the service, its connection pool keeps the TLS session
+        # to S3 open between files instead of a new handshake per file
+        if self._client is None:
+            import boto3  # pylint: disable=import-error # pytype: disable=import-error
+            from botocore.config import Config  # pylint: disable=import-error # pytype: disable=import-error
+            s3_config = {}
+            if self.endpoint_url:
+                s3_config['addressing_style'] = 'path'
+            config = Config(
+                max_pool_connections=self.max_pool_connections,
+                tcp_keepalive=True,
+                retries={'total_max_attempts': self.max_attempts, 'mode': 'standard'},
+                s3=s3_config)
+            self._client = boto3.session.Session().client('s3', endpoint_url=self.endpoint_url, config=config)
+        return self._client
+
+    def key(self, path):
+        name = os.path.basename(path)
+        if self.prefix and not self.prefix.endswith('/'):
+            return f'{self.prefix}/{name}'
+        return f'{self.prefix}{name}'
+
+    def upload(self, path):
+        start = time.monotonic()
+        size = os.path.getsize(path)
+        key = self.key(path)
+        sha256 = None
+        if self.manifest is not None:
+            sha256 = file_sha256(path)
+            entry = self.manifest.lookup(sha256, key=key)
+            if entry is not None:
+                print(f'skipping {path}, already uploaded to s3://{self.bucket}/{entry["key"]}')
+                # this copy is the one on disk now, freespacer looks uploads up by path
+                self.manifest.record(sha256, entry['size'], entry['key'], path, uploaded=entry['uploaded'])
+                return True
+        try:
+            if size >= self.multipart_threshold:
+                self.upload_multipart(path, key)
+            else:
+                with open(path, 'rb') as f:
+                    self.client.put_object(Bucket=self.bucket, Key=key, Body=ThrottledReader(f, self.throttle))
+        except Exception as err:
+            print(f'upload of {path} to s3://{self.bucket}/{key} failed: {err}')
+            return False
+        if self.manifest is not None:
+            self.manifest.record(sha256, size, key, path)
+        elapsed = time.monotonic() - start
+        print(f'uploaded {path} ({size} bytes) to s3://{self.bucket}/{key} in {elapsed:.2f}s')
+        return True
+
+    def stream_archive(self, filedir, files, name, codec='none', level=None):
+        # nothing is staged on flash, the sources are only removed once S3 completes the upload
+        # and a failed stream can't be resumed like upload_multipart, it starts over next job
+        start = time.monotonic()
+        key = self.key(name)
+        writer = MultipartWriter(self, key)
+        added = []
+        try:
+            archive = ArchiveWriter(writer, codec=codec, level=level)
+            for file in sorted(files):
+                path = os.path.join(filedir, file)
+                if archive.add(path, file, os.lstat(path)):
+                    added.append(file)
+            archive.close()
+            writer.complete()
+        except Exception as err:
+            print(f'streaming {filedir} to s3://{self.bucket}/{key} failed: {err}')
+            writer.abort()
+            return False
+        if self.manifest is not None:
+            # there's no local copy of a stream, freespacer mustn't take the directory for one
+            self.manifest.record(writer.sha256.hexdigest(), writer.bytes, key, '')
+        remove_sources(filedir, added)
+        elapsed = time.monotonic() - start
+        print(f'streamed {len(files)} files from {filedir} ({writer.bytes} bytes) to s3://{self.bucket}/{key} in {elapsed:.2f}s')
+        return True
+
+    def upload_multipart(self, path, key):
+        stat = os.stat(path)
+        journal = UploadJournal(self.journal_dir, path)
+        state = journal.load(key, stat.st_size, stat.st_mtime, self.part_size)
+        if state is None:
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)
+            journal.start(key, stat.st_size, stat.st_mtime, self.part_size, response['UploadId'])
+            state = journal.state
+        else:
+            print(f'resuming upload of {path} after {len(state["parts"])} parts')
+        upload_id = state['upload_id']
+        parts = (stat.st_size + self.part_size - 1) // self.part_size
+        try:
+            with open(path, 'rb') as f:
+                for number in range(1, parts + 1):
+                    if str(number) in state['parts']:
+                        continue
+                    f.seek((number - 1) * self.part_size)
+                    data = f.read(self.part_size)
+                    md5 = hashlib.md5(data)
+                    response = self.client.upload_part(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                        Body=ThrottledReader(io.BytesIO(data), self.throttle),
+                        ContentMD5=base64.b64encode(md5.digest()).decode('ascii'))
+                    journal.add_part(number, response['ETag'], md5.hexdigest())
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': int(number), 'ETag': part['etag']}
+                                           for number, part in sorted(state['parts'].items(), key=lambda p: int(p[0]))]})
+        except Exception as err:
+            # an upload S3 no longer knows about can't be resumed, start over next time
+            if getattr(err, 'response', {}).get('Error', {}).get('Code') == 'NoSuchUpload':
+                journal.remove()
+            raise
+        journal.remove()
+
+
+# telemetry type: (priority class, seconds from the file's mtime until it should be in the bucket)
+# class 0 is urgent and has its own workers, lower classes go first
+UPLOAD_PRIORITIES = {
+    'status': (0, 3600),
+    'power': (1, 6 * 3600),
+    'sensors': (1, 6 * 3600),
+    'gps': (1, 6 * 3600),
+    'system': (2, 86400),
+    'ais': (2, 86400),
+    'hydrophone': (3, 7 * 86400),
+}
+DEFAULT_PRIORITY = (2, 86400)
+
+
+def parse_priorities(config):
+    # "status=0:3600,hydrophone=3:604800" -> {'status': (0, 3600), 'hydrophone': (3, 604800)}
+    priorities = dict(UPLOAD_PRIORITIES)
+    for entry in config.split(','):
+        if entry.strip():
+            telemetry, _, spec = entry.partition('=')
+            priority, _, deadline = spec.partition(':')
+            priorities[telemetry.strip()] = (int(priority), int(deadline or DEFAULT_PRIORITY[1]))
+    return priorities
+
+
+class UploadBatch:
+    # the files of one s3_copy pass, done when each is uploaded or has failed
+
+    def __init__(self, count, queue_depth):
+        self.pending = count
+        self.stats = {'files': 0, 'failed': 0, 'late': 0, 'bytes': 0, 'max_queue_depth': queue_depth}
+        self.start = time.monotonic()
+        self.done = threading.Event()
+        if not count:
+            self.finish()
+
+    def finish(self):
+        stats = self.stats
+        stats['seconds'] = round(time.monotonic() - self.start, 2)
+        stats['bytes_per_second'] = round(stats['bytes'] / stats['seconds']) if stats['seconds'] else 0
+        print(f'uploaded {stats["files"]} files ({stats["bytes"]} bytes) in {stats["seconds"]}s, '
+              f'{stats["bytes_per_second"]} bytes/s, queue depth {stats["max_queue_depth"]}, '
+              f'{stats["failed"]} failed, {stats["late"]} past their deadline')
+        self.done.set()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.stats
+
+
+class UploadPool:
+    # files go by their type's priority class, then deadline, then size, chosen whenever a worker is free,
+    # past their deadline they move up to class 1 but never ahead of class 0, which urgent_workers keep free for
+
+    def __init__(self, uploader, workers=2, retries=3, backoff_seconds=5, priorities=None, urgent_workers=1):
+        self.uploader = uploader
+        self.workers = workers
+        self.urgent_workers = urgent_workers
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.priorities = priorities or UPLOAD_PRIORITIES
+        self.pending = []
+        self.active = set()
+        self.cond = threading.Condition()
+        self.threads = []
+        self.seq = 0
+
+    def priority(self, name):
+        telemetry = os.path.basename(name).split('-')[0]
+        return self.priorities.get(telemetry, DEFAULT_PRIORITY)
+
+    def upload_with_retry(self, upload):
+        for attempt in range(self.retries + 1):
+            if upload():
+                return True
+            if attempt < self.retries:
+                time.sleep(min(self.backoff_seconds * 2 ** attempt, 300))
+        return False
+
+    def start(self):
+        if self.threads:
+            return
+        for i in range(self.workers + self.urgent_workers):
+            thread = threading.Thread(target=self.worker, args=(i < self.urgent_workers,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit_task(self, name, size, upload, batch, deadline):
+        priority_class = self.priority(name)[0]
+        self.pending.append({
+            'name': name, 'size': size, 'upload': upload, 'batch': batch,
+            'class': priority_class, 'deadline': deadline, 'seq': self.seq})
+        self.seq += 1
+
+    def file_upload(self, path, on_success):
+
+        def upload():
+            if not self.uploader.upload(path):
+                return False
+            if on_success is not None:
+                on_success(path)
+            return True
+
+        return upload
+
+    def submit(self, paths, on_success=None, tasks=()):
+        # (name, size, upload) tasks are queued alongside the files, like streamed archives
+        now = time.time()
+        with self.cond:
+            entries = []
+            for path in paths:
+                if path in self.active:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # uploaded and removed by a worker since it was listed
+                    continue
+                entries.append((path, stat.st_size, self.file_upload(path, on_success), stat.st_mtime + self.priority(path)[1]))
+            for name, size, upload in tasks:
+                if name not in self.active:
+                    entries.append((name, size, upload, now + self.priority(name)[1]))
+            batch = UploadBatch(len(entries), len(self.pending) + len(entries))
+            for name, size, upload, deadline in entries:
+                self.active.add(name)
+                self.submit_task(name, size, upload, batch, deadline)
+            self.cond.notify_all()
+        self.start()
+        return batch
+
+    def next_task(self, urgent):
+        now = time.time()
+
+        def key(task):
+            priority_class = task['class']
+            if now > task['deadline']:
+                priority_class = min(priority_class, 1)
+            return (priority_class, task['deadline'], task['size'], task['seq'])
+
+        candidates = [task for task in self.pending if not urgent or task['class'] == 0]
+        if not candidates:
+            return None
+        task = min(candidates, key=key)
+        self.pending.remove(task)
+        return task
+
+    def worker(self, urgent):
+        while True:
+            with self.cond:
+                task = self.next_task(urgent)
+                while task is None:
+                    self.cond.wait()
+                    task = self.next_task(urgent)
+            uploaded = False
+            try:
+                uploaded = self.upload_with_retry(task['upload'])
+            except Exception as err:
+                print(f'upload of {task["name"]} failed: {err}')
+            batch = task['batch']
+            with self.cond:
+                self.active.discard(task['name'])
+                if uploaded:
+                    batch.stats['files'] += 1
+                    batch.stats['bytes'] += task['size']
+                    if time.time() > task['deadline']:
+                        batch.stats['late'] += 1
+                else:
+                    batch.stats['failed'] += 1
+                batch.pending -= 1
+                finished = batch.pending == 0
+            if finished:
+                batch.finish()
+
+    def run(self, paths, on_success=None):
+        return self.submit(paths, on_success=on_success).wait()
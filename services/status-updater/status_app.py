@@ -36,8 +36,12 @@ class Telemetry:
         self.hydrophone_dir = os.path.join(base_dir, 'hydrophone')
         self.power_dir = os.path.join(base_dir, 'power')
         self.s3_dir = '/flash/s3'
+        # running eviction totals and the fill forecast, written by freespacer
+        self.freespacer_file = os.path.join(base_dir, '.freespacer.json')
         self.ais_file = os.path.join(self.ais_dir, 'false')
-        self.ais_records = 0
+        self.ais_size = 0
+        self.ais_summary_file = os.path.join(self.ais_dir, 'false')
+        self.ais_summary = {}
         self.gps_file = os.path.join(self.gps_dir, 'false')
         self.hydrophone_file = os.path.join(self.hydrophone_dir, 'false')
         self.hydrophone_size = 0
@@ -106,7 +110,8 @@ class Telemetry:
     def check_ais(self):
         # check for new files, in the newest file, check if the number of lines has increased
         try:
-            files = sorted([f for f in os.listdir(self.ais_dir) if os.path.isfile(os.path.join(self.ais_dir, f))])
+            # only the record files (JSONL or binary segments), the daisy service also writes per window stats files
+            files = sorted([f for f in os.listdir(self.ais_dir) if f.endswith(('-ais.json', '-ais.seg')) and os.path.isfile(os.path.join(self.ais_dir, f))])
             # check for dotfiles
             files = self.reorder_dots(files)
         except FileNotFoundError:
@@ -114,19 +119,48 @@ class Telemetry:
 
         if not files:
             self.ais_file = os.path.join(self.ais_dir, 'false')
-            self.ais_records = 0
+            self.ais_size = 0
             return False
         elif os.path.join(self.ais_dir, files[-1]) != self.ais_file:
             self.ais_file = os.path.join(self.ais_dir, files[-1])
-            self.ais_records = sum(1 for line in open(self.ais_file))
+            self.ais_size = os.path.getsize(self.ais_file)
             return True
-        # file already exists, check if there's new records
-        num_lines = sum(1 for line in open(self.ais_file))
-        if num_lines > self.ais_records:
-            self.ais_records = num_lines
+        # file already exists, check if there's new records (records are only ever appended)
+        size = os.path.getsize(self.ais_file)
+        if size > self.ais_size:
+            self.ais_size = size
             return True
         return False
 
+    def check_ais_summary(self, timestamp):
+        # the daisy service writes a small traffic summary per window, no need to read the records
+        try:
+            files = sorted([f for f in os.listdir(self.ais_dir) if f.endswith('-ais-stats.json') and not f.startswith('.')])
+        except FileNotFoundError:
+            files = None
+
+        if not files:
+            return
+        if os.path.join(self.ais_dir, files[-1]) != self.ais_summary_file:
+            self.ais_summary_file = os.path.join(self.ais_dir, files[-1])
+            with open(self.ais_summary_file, 'r') as f:
+                self.ais_summary = json.loads(f.readline())
+        stats = self.ais_summary
+        traffic = stats.get('traffic', {})
+        self.sensor_data['ais_messages'].append([traffic.get('messages', stats.get('decoded')), timestamp])
+        self.sensor_data['ais_unique_mmsi'].append([traffic.get('unique_mmsi'), timestamp])
+        if traffic.get('closest_m') is not None:
+            self.sensor_data['ais_closest_vessel_m'].append([traffic['closest_m'], timestamp])
+        # receiver health, a quiet channel with lines still arriving is not a stalled UART
+        for channel, counts in stats.get('channels', {}).items():
+            self.sensor_data[f'ais_channel_{channel.lower()}_per_minute'].append([counts['per_minute'], timestamp])
+        if 'bad' in stats:
+            self.sensor_data['ais_decode_failures'].append([stats['bad'], timestamp])
+        if 'max_gap_ms' in stats:
+            self.sensor_data['ais_max_gap_ms'].append([stats['max_gap_ms'], timestamp])
+        if stats.get('latency_ms'):
+            self.sensor_data['ais_latency_p99_ms'].append([stats['latency_ms']['p99'], timestamp])
+
     def check_gps(self, timestamp):
         try:
             files = sorted([f for f in os.listdir(self.gps_dir) if os.path.isfile(os.path.join(self.gps_dir, f))])
@@ -242,7 +276,9 @@ class Telemetry:
 
     def check_s3(self):
         try:
-            files = sorted([f for f in os.listdir(self.s3_dir) if os.path.isfile(os.path.join(self.s3_dir, f))])
+            # dotfiles are in progress or state like the upload manifest, not files to upload
+            files = sorted([f for f in os.listdir(self.s3_dir)
+                            if not f.startswith('.') and os.path.isfile(os.path.join(self.s3_dir, f))])
         except FileNotFoundError:
             files = None
 
@@ -251,6 +287,22 @@ class Telemetry:
         else:
             return True, len(files)
 
+    def check_freespacer(self, timestamp):
+        try:
+            with open(self.freespacer_file, 'r') as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            return
+        forecast = stats.get('forecast', {})
+        if forecast.get('hours_to_full') is not None:
+            self.sensor_data["disk_hours_to_full"].append([forecast['hours_to_full'], timestamp])
+            self.alerts['disk_hours_to_full'] = forecast['hours_to_full'] < 24
+        else:
+            self.alerts['disk_hours_to_full'] = False
+        if forecast.get('bytes_per_hour') is not None:
+            self.sensor_data["disk_fill_mb_per_hour"].append([round(forecast['bytes_per_hour'] / 1024 / 1024, 1), timestamp])
+        self.sensor_data["data_lost_mb"].append([round(stats.get('lost_bytes', 0) / 1024 / 1024, 1), timestamp])
+
     def init_sensor_data(self):
         self.sensor_data = defaultdict(list)
         self.sensor_data.update({
@@ -343,6 +395,7 @@ class Telemetry:
                 self.sensor_data["ais_record"].append([ais, timestamp])
             else:
                 self.sensor_data["ais_record"] = [[ais, timestamp]]
+        self.check_ais_summary(timestamp)
 
         # recordings: see if new recording file since last session, or if more bytes have been written
         hydrophone = self.check_hydrophone()
@@ -360,6 +413,9 @@ class Telemetry:
             else:
                 self.sensor_data["files_to_upload"] = [[s3_files, timestamp]]
 
+        # disk: how long until it's full, and data evicted before it was uploaded
+        self.check_freespacer(timestamp)
+
         # battery: check current battery level from pijuice hopefully, change color based on level
         self.check_power()
         if 'battery_status' in self.sensor_data: